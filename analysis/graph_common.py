@@ -1,8 +1,7 @@
 from __future__ import print_function, division
 import os.path
 import collections
-import matplotlib.pyplot as plt
-from matplotlib.ticker import ScalarFormatter
+import json
 import numpy as np
 
 """
@@ -19,6 +18,11 @@ def draw_histogram(latencies_ms,
     """
     Draw one individual histogram.
     """
+    # Imported here rather than at module level so that the statistics
+    # functions below can be used without paying for matplotlib's startup
+    import matplotlib.pyplot as plt
+    from matplotlib.ticker import ScalarFormatter
+
     n, bins, patches = plt.hist(latencies_ms, bins, color='white', edgecolor='black', hatch='/')
     if draw_xlabel:
         plt.xlabel("Packet latency (ms)")
@@ -41,7 +45,7 @@ def read_latencies_file(latencies_filename):
     latencies_ms = []
     total_n_packets = int(lines[0])
     for line in lines[1:]:
-        if len(line) == 0:
+        if len(line) == 0 or line.startswith('#'):
             continue
         fields = line.split(' ')
         packet_n = int(fields[0])
@@ -54,6 +58,75 @@ def read_latencies_file(latencies_filename):
     return (packet_ns, latencies_ms, total_n_packets)
 
 
+def read_corrected_latencies_file(latencies_filename):
+    """
+    Read the latencies measured from each packet's scheduled (rather than
+    actual) send time, from the optional third column of one recording file.
+    Returns None if the file doesn't have them.
+    """
+    with open(latencies_filename, 'r') as latencies_file:
+        lines = latencies_file.read().split('\n')
+    corrected_latencies_ms = []
+    for line in lines[1:]:
+        if len(line) == 0 or line.startswith('#'):
+            continue
+        fields = line.split(' ')
+        if len(fields) < 3:
+            return None
+        corrected_latencies_ms.append(float(fields[2]) / 1000)
+    return np.array(corrected_latencies_ms)
+
+
+def read_latencies_file_metadata(latencies_filename):
+    """
+    Read the '# key value' metadata lines (e.g. socket drop counters) from one
+    recording file, returning them as a dictionary.
+    """
+    metadata = {}
+    with open(latencies_filename, 'r') as latencies_file:
+        for line in latencies_file:
+            if not line.startswith('#'):
+                continue
+            (key, value) = line[1:].split(None, 1)
+            value = value.strip()
+            for value_type in (int, float):
+                try:
+                    value = value_type(value)
+                    break
+                except ValueError:
+                    pass
+            metadata[key] = value
+    return metadata
+
+
+def calc_local_drop_statistics(n_totally_dropped, total_n_packets, metadata):
+    """
+    Split the packets which were totally dropped into those dropped by the
+    receiving host itself (because its socket receive buffer overflowed) and
+    those lost on the network, using the drop counters recorded in a file's
+    metadata. Returns None if the file has no drop counters.
+    """
+    counters = [metadata[key] for key in
+                ['rxq_overflow_drops', 'proc_net_udp_drops'] if key in metadata]
+    if len(counters) == 0:
+        return None
+    # SO_RXQ_OVFL counts only reach us attached to the next packet received,
+    # so drops after the last packet only show up in /proc/net/udp
+    n_local_drops = max(counters)
+    # The counters can also include packets which weren't part of this
+    # measurement, so don't let them account for more than were missing
+    n_local_drops = min(n_local_drops, n_totally_dropped)
+    n_network_drops = n_totally_dropped - n_local_drops
+
+    LocalDropStats = collections.namedtuple(
+        "LocalDropStats",
+        "pct_network_dropped pct_local_overflow_dropped n_network_dropped n_local_overflow_dropped"
+    )
+    return LocalDropStats(100 * (n_network_drops / total_n_packets),
+                          100 * (n_local_drops / total_n_packets),
+                          n_network_drops, n_local_drops)
+
+
 def read_latencies_files(filenames):
     """
     Read latency data from multiple files, and return the data from each file as
@@ -114,12 +187,13 @@ def calculate_histogram_bins(packet_data, n_bins=20, min_latency_ms=1):
 
 
 def calc_basic_statistics(packet_ns, latencies_ms, total_n_packets,
-                          cutoff_time_ms):
+                          cutoff_time_ms, verbose=True):
     """
     Calculate number/percentage of packets totally dropped and arriving beyond
     the specified cutoff time
     """
-    print("Calculating basic drop statistics...", end='')
+    if verbose:
+        print("Calculating basic drop statistics...", end='')
 
     n_totally_dropped = total_n_packets - len(packet_ns)
     pct_totally_dropped = 100 * (n_totally_dropped / total_n_packets)
@@ -134,19 +208,21 @@ def calc_basic_statistics(packet_ns, latencies_ms, total_n_packets,
         "pct_totally_dropped pct_dropped_or_beyond_cutoff n_totally_dropped n_dropped_or_beyond_cutoff"
     )
 
-    print("done!")
+    if verbose:
+        print("done!")
     return BasicStats(pct_totally_dropped, pct_dropped_or_beyond_cutoff,
                       n_totally_dropped, n_dropped_or_beyond_cutoff)
 
 
 def calc_consecutive_drop_statistics(packet_ns, latencies_ms, total_n_packets,
-                                     cutoff_time_ms):
+                                     cutoff_time_ms, verbose=True):
     """
     Calculate the number of times that two packets in a row are dropped or
     delayed, considering two scenarios:
     1) out-of-order packets are dropped 2) packets are reordered
     """
-    print("Calculating consecutive drop statistics...")
+    if verbose:
+        print("Calculating consecutive drop statistics...")
 
     # First, generate a list of booleans representing whether each
     # original packet was received OK
@@ -203,59 +279,274 @@ def find_out_of_order_packet_indices(packet_ns):
         0, 1, 2, 3, 5, 4, 6, 7.
     return index 5 (corresponding to '4').
     """
-    indices = []
-    prev_packet_n = packet_ns[0] - 1
-    for i in range(len(packet_ns)):
-        packet_n = packet_ns[i]
-        if packet_n > prev_packet_n:
-            # say, if the previous packet was 2, and now we're at 3
-            # or if the previous packet was 3, and now we're at 5
-            prev_packet_n = packet_n
-        elif packet_n < prev_packet_n:
-            # e.g. if the previous packet was 5, and we're now at 4
-            # (having given up all hope of seeing 4 again when we saw 5)
-            indices.append(i)
-    return indices
+    packet_ns = np.asarray(packet_ns)
+    if len(packet_ns) == 0:
+        return np.array([], dtype=int)
+    # A packet is out of order if a higher-numbered packet arrived before it
+    # (the 'next expected' test of RFC 4737)
+    running_max = np.maximum.accumulate(packet_ns)
+    return np.flatnonzero(packet_ns[1:] < running_max[:-1]) + 1
+
+
+def calc_reorder_extents(packet_ns):
+    """
+    Return the reorder extent (RFC 4737 section 4.2.2) of each out-of-order
+    packet: how many packets earlier than it arrived the first packet which
+    was sent after it. A receiver would need to buffer that many packets to put
+    it back in order.
+
+    Runs in time linear in the number of packets (and the range of packet
+    numbers).
+    """
+    packet_ns = np.asarray(packet_ns, dtype=np.int64)
+    out_of_order_indices = find_out_of_order_packet_indices(packet_ns)
+    if len(out_of_order_indices) == 0:
+        return np.array([], dtype=np.int64)
+
+    # Packets which set a new running maximum, in arrival order; packet
+    # numbers from one record up to the next are first exceeded by the next
+    running_max = np.maximum.accumulate(packet_ns)
+    is_record = np.empty(len(packet_ns), dtype=bool)
+    is_record[0] = True
+    is_record[1:] = packet_ns[1:] > running_max[:-1]
+    record_indices = np.flatnonzero(is_record)
+    record_packet_ns = packet_ns[record_indices]
+    # (Packets numbered below the first packet to arrive were exceeded by it)
+    first_exceeded_at = np.concatenate((
+        record_indices[:1],
+        np.repeat(record_indices[1:], np.diff(record_packet_ns))))
+
+    late_packet_ns = packet_ns[out_of_order_indices]
+    lookup_indices = np.maximum(late_packet_ns - record_packet_ns[0] + 1, 0)
+    return out_of_order_indices - first_exceeded_at[lookup_indices]
+
+
+def calc_reorder_displacements(packet_ns):
+    """
+    Return the displacement (RFC 5236) of each packet received: its position
+    in the order packets arrived minus its position in the order they were
+    sent, counting only packets which were received. Late packets have
+    positive displacements, and the packets they were overtaken by negative.
+
+    Runs in time linear in the number of packets (and the range of packet
+    numbers).
+    """
+    packet_ns = np.asarray(packet_ns, dtype=np.int64)
+    if len(packet_ns) == 0:
+        return np.array([], dtype=np.int64)
+    min_packet_n = packet_ns.min()
+    counts = np.bincount(packet_ns - min_packet_n)
+    # Where each packet number comes in send order (duplicates share one slot)
+    send_positions = np.cumsum(counts) - counts
+    return (np.arange(len(packet_ns)) -
+            send_positions[packet_ns - min_packet_n])
+
+
+def count_values(values):
+    """
+    Return a dictionary mapping each distinct integer in values to how many
+    times it appears.
+    """
+    values = np.asarray(values, dtype=np.int64)
+    if len(values) == 0:
+        return {}
+    min_value = values.min()
+    counts = np.bincount(values - min_value)
+    nonzero = np.flatnonzero(counts)
+    return dict((int(value), int(count))
+                for (value, count) in zip(nonzero + min_value, counts[nonzero]))
+
+
+def calc_reorder_buffer_sizes(reorder_extents, coverage_pcts):
+    """
+    Return, for each coverage percentage, the smallest reorder buffer (in
+    packets) which would put back in order that percentage of the out-of-order
+    packets with the given reorder extents.
+    """
+    reorder_extents = np.asarray(reorder_extents)
+    if len(reorder_extents) == 0:
+        return [0] * len(coverage_pcts)
+    ranks = [max(int(np.ceil(len(reorder_extents) * pct / 100)) - 1, 0)
+             for pct in coverage_pcts]
+    partitioned = np.partition(reorder_extents, sorted(set(ranks)))
+    return [int(partitioned[rank]) for rank in ranks]
+
+
+def calc_reordering_statistics(packet_ns, verbose=True, reorder_extents=None,
+                               displacements=None):
+    """
+    Calculate how many packets arrived out of order, and how far out of order
+    (see calc_reorder_extents and calc_reorder_displacements). The reorder
+    extents and displacements can be passed in if they've already been
+    calculated, to save working them out again.
+    """
+    if verbose:
+        print("Calculating reordering statistics...", end='')
+
+    if reorder_extents is None:
+        reorder_extents = calc_reorder_extents(packet_ns)
+    if displacements is None:
+        displacements = calc_reorder_displacements(packet_ns)
+    n_reordered = len(reorder_extents)
+    if len(packet_ns) > 0:
+        pct_reordered = 100 * n_reordered / len(packet_ns)
+    else:
+        pct_reordered = 0
+    max_reorder_extent = reorder_extents.max() if n_reordered > 0 else 0
+    max_displacement = displacements.max() if len(displacements) > 0 else 0
+
+    ReorderingStats = collections.namedtuple(
+        "ReorderingStats",
+        "n_reordered pct_reordered max_reorder_extent max_reorder_displacement"
+    )
+
+    if verbose:
+        print("done!")
+    return ReorderingStats(n_reordered, pct_reordered, max_reorder_extent,
+                           max_displacement)
 
 
 def packets_received_within_cutoff(packet_ns, latencies_ms, total_n_packets,
                                    cutoff_time_ms):
     """
-    Return a list of booleans indicating whether each of the total_n_packets
+    Return an array of booleans indicating whether each of the total_n_packets
     packets was received before the specified cutoff time.
     """
-    received_packets = []
-    for packet_n in range(total_n_packets):
-        idx = np.where(packet_ns == packet_n)[0]
-        if len(idx) == 0:
-            # Packet wasn't received at all
-            received_packets.append(False)
-        elif latencies_ms[idx] > cutoff_time_ms:
-            # Received beyond cutoff
-            received_packets.append(False)
-        else:
-            received_packets.append(True)
+    packet_ns = np.asarray(packet_ns, dtype=np.int64)
+    latencies_ms = np.asarray(latencies_ms)
+    received_packets = np.zeros(total_n_packets, dtype=bool)
+    in_time = ((latencies_ms <= cutoff_time_ms) & (packet_ns >= 0) &
+               (packet_ns < total_n_packets))
+    received_packets[packet_ns[in_time]] = True
     return received_packets
 
 
 def count_consecutive_n_drops(packets_received, n_drops):
-    # This is horrible, but the basic idea is:
-    # a = [1, 2, 3, 4, 5]
-    # In [25]: zip(a[0:-1], a[1:])
-    # Out[25]: [(1, 2), (2, 3), (3, 4), (4, 5)]
-    # In [26]: zip(a[0:-2], a[1:], a[2:])
-    # Out[26]: [(1, 2, 3), (2, 3, 4), (3, 4, 5)]
-    zip_list = []
-    shift = packets_received[0:-(n_drops - 1)]
-    zip_list.append(shift)
+    """
+    Count the runs of n_drops consecutive packets (overlapping runs counted
+    separately) which weren't received, given a list of booleans indicating
+    whether each packet was received.
+    """
+    dropped = ~np.asarray(packets_received, dtype=bool)
+    n_windows = len(dropped) - (n_drops - 1)
+    if n_windows <= 0:
+        return 0
+    all_dropped = dropped[:n_windows].copy()
     for i in range(1, n_drops):
-        shift = packets_received[i:]
-        zip_list.append(shift)
-    packet_blocks = zip(*zip_list)
+        all_dropped &= dropped[i:i + n_windows]
+    return int(np.count_nonzero(all_dropped))
+
+
+def read_sketch_file(sketch_filename):
+    """
+    Read a latency sketch (the '.sketch' file saved next to each recording
+    file) as a dictionary.
+    """
+    with open(sketch_filename, 'r') as sketch_file:
+        sketch = json.load(sketch_file)
+    sketch['bucket_counts'] = dict(
+        (int(index), count) for (index, count) in sketch['bucket_counts'].items())
+    # Sketches from before corrected latencies were recorded have none
+    sketch['corrected_bucket_counts'] = dict(
+        (int(index), count) for (index, count)
+        in sketch.get('corrected_bucket_counts', {}).items())
+    sketch['loss_burst_lengths'] = dict(
+        (int(length), count)
+        for (length, count) in sketch['loss_burst_lengths'].items())
+    return sketch
+
+
+def merge_sketches(sketches):
+    """
+    Merge latency sketches from multiple hosts or runs into a single sketch.
+    Memory use depends only on the range of latencies, not on the number of
+    packets.
+    """
+    merged = dict(sketches[0])
+    merged['bucket_counts'] = collections.Counter()
+    merged['corrected_bucket_counts'] = collections.Counter()
+    merged['loss_burst_lengths'] = collections.Counter()
+    merged['n_packets_expected'] = 0
+    merged['n_packets_received'] = 0
+    for sketch in sketches:
+        if (sketch['min_latency_us'] != merged['min_latency_us'] or
+                sketch['growth'] != merged['growth']):
+            raise ValueError("Can't merge sketches with different bucket layouts")
+        merged['bucket_counts'].update(sketch['bucket_counts'])
+        merged['corrected_bucket_counts'].update(
+            sketch['corrected_bucket_counts'])
+        merged['loss_burst_lengths'].update(sketch['loss_burst_lengths'])
+        merged['n_packets_expected'] += sketch['n_packets_expected']
+        merged['n_packets_received'] += sketch['n_packets_received']
+    # Corrected percentiles only mean something if every sketch had them
+    if (sum(merged['corrected_bucket_counts'].values()) !=
+            sum(merged['bucket_counts'].values())):
+        merged['corrected_bucket_counts'] = collections.Counter()
+    return merged
+
+
+def sketch_bucket_latency_us(sketch, index):
+    """
+    Return the representative latency of one bucket of a sketch: the value
+    within the bucket with the smallest worst-case relative error.
+    """
+    if index == 0:
+        return sketch['min_latency_us']
+    growth = sketch['growth']
+    return sketch['min_latency_us'] * growth ** index * 2 / (1 + growth)
 
-    consecutive_n_drops = 0
-    for packet_block in packet_blocks:
-        if list(packet_block) == [False] * n_drops:
-            consecutive_n_drops += 1
 
-    return consecutive_n_drops
+def sketch_percentiles_ms(sketch, percentiles, corrected=False):
+    """
+    Estimate latency percentiles (in milliseconds) from a sketch: of the raw
+    latencies, or with corrected=True, of the latencies corrected to each
+    packet's scheduled send time.
+    """
+    bucket_counts = sketch['corrected_bucket_counts' if corrected
+                           else 'bucket_counts']
+    indices = sorted(bucket_counts)
+    n_latencies = sum(bucket_counts.values())
+    values = []
+    for percentile in percentiles:
+        if n_latencies == 0:
+            values.append(float('nan'))
+            continue
+        rank = percentile / 100 * (n_latencies - 1)
+        cumulative_count = 0
+        for index in indices:
+            cumulative_count += bucket_counts[index]
+            if cumulative_count > rank:
+                break
+        values.append(sketch_bucket_latency_us(sketch, index) / 1000)
+    return values
+
+
+def calc_sketch_statistics(sketch, cutoff_time_ms):
+    """
+    Calculate drop statistics from a sketch: the same quantities as
+    calc_basic_statistics, plus statistics on bursts of consecutive lost
+    packets (as opposed to delayed ones, which the sketch can't place in
+    sequence).
+    """
+    total_n_packets = sketch['n_packets_expected']
+    n_totally_dropped = total_n_packets - sketch['n_packets_received']
+    n_made_it = sum(
+        count for (index, count) in sketch['bucket_counts'].items()
+        if sketch_bucket_latency_us(sketch, index) / 1000 < cutoff_time_ms)
+    n_dropped_or_beyond_cutoff = total_n_packets - n_made_it
+
+    bursts = sketch['loss_burst_lengths']
+    n_consecutive_losses = sum(
+        (length - 1) * count for (length, count) in bursts.items())
+    max_loss_burst = max(bursts) if bursts else 0
+
+    SketchStats = collections.namedtuple(
+        "SketchStats",
+        "pct_totally_dropped pct_dropped_or_beyond_cutoff n_totally_dropped n_dropped_or_beyond_cutoff pct_consecutive_losses n_loss_bursts max_loss_burst"
+    )
+    return SketchStats(
+        100 * (n_totally_dropped / total_n_packets),
+        100 * (n_dropped_or_beyond_cutoff / total_n_packets),
+        n_totally_dropped, n_dropped_or_beyond_cutoff,
+        100 * n_consecutive_losses / max(total_n_packets - 1, 1),
+        sum(bursts.values()), max_loss_burst)
@@ -10,56 +10,67 @@ from __future__ import print_function, division
 import argparse
 import os.path
 import numpy as np
-import matplotlib
 import graph_common
 
 description = """Plot graphs of latency measurements made by packet_latency_tester.
 Specifically, plot a timeseries of latencies and a
-histogram of packet latency distribution."""
-parser = argparse.ArgumentParser(description=description)
-
-parser.add_argument(
-    "measurement_filenames",
-    nargs='+',
-    help='One or more latency measurement files produced by packet_latency_tester'
-)
-parser.add_argument(
-    "--cutoff_time_ms",
-    type=int,
-    default=10,
-    help='The latency beyond which packets are considered delayed')
-parser.add_argument(
-    "--histogram_merge_all_files",
-    action='store_true',
-    help='Merge packet latencies from all files when drawing the histogram')
-
-parser.add_argument(
-    "--noninteractive",
-    action='store_true',
-    help='Only save the graphs to .png files without showing anything on screen'
-)
-parser.add_argument(
-    "--fast",
-    action='store_true',
-    help="Don't calculate statistics which take a while to compute")
-parser.add_argument("--no_histograms", action='store_true')
-parser.add_argument("--no_timeseries", action='store_true')
-
-parser.add_argument(
-    "--output_postfix",
-    default='',
-    help="Postfix for the output graph filesnames")
-args = parser.parse_args()
-
-if args.noninteractive:
-    matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+histogram of packet latency distribution.
+(For numbers only, without plotting, see latency_stats.py.)"""
+
+
+def parse_args():
+    """
+    Parse arguments.
+    """
+    parser = argparse.ArgumentParser(description=description)
+
+    parser.add_argument(
+        "measurement_filenames",
+        nargs='+',
+        help='One or more latency measurement files produced by packet_latency_tester'
+    )
+    parser.add_argument(
+        "--cutoff_time_ms",
+        type=int,
+        default=10,
+        help='The latency beyond which packets are considered delayed')
+    parser.add_argument(
+        "--histogram_merge_all_files",
+        action='store_true',
+        help='Merge packet latencies from all files when drawing the histogram')
+
+    parser.add_argument(
+        "--noninteractive",
+        action='store_true',
+        help='Only save the graphs to .png files without showing anything on screen'
+    )
+    parser.add_argument(
+        "--fast",
+        action='store_true',
+        help="Don't calculate statistics which take a while to compute")
+    parser.add_argument("--no_histograms", action='store_true')
+    parser.add_argument("--no_timeseries", action='store_true')
+
+    parser.add_argument(
+        "--output_postfix",
+        default='',
+        help="Postfix for the output graph filesnames")
+    return parser.parse_args()
 
 
 def main():
     """
     Call appropriate drawing functions depending on command-line arguments.
     """
+    args = parse_args()
+
+    # matplotlib is only imported once we know we're going to plot (and which
+    # backend to plot with), so that importing this module stays cheap
+    import matplotlib
+    if args.noninteractive:
+        matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+
     data_path = os.path.dirname(args.measurement_filenames[0])
     data_all_files = graph_common.read_latencies_files(
         args.measurement_filenames)
@@ -82,6 +93,8 @@ def draw_histograms(packets_all_hosts, histogram_merge_all_files,
     """
     Draw histograms of packet latency.
     """
+    import matplotlib.pyplot as plt
+
     if histogram_merge_all_files:
         packet_data = graph_common.merge_all_hosts(packets_all_hosts)
     else:
@@ -148,6 +161,8 @@ def draw_timeseries(packets_all_hosts, cutoff_time_ms, save_dir,
     Draw a timeseries of packet latencies over time, in order that the packets
     were sent in
     """
+    import matplotlib.pyplot as plt
+
     plt.figure()
     plt.suptitle("Packet latency over time")
 
@@ -244,4 +259,5 @@ def drops_or_delays_in_each_bin(packet_ns,
     return (bin_starts, bin_width_packets, drops)
 
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+Summarise packet latency measurements made by packet_latency_tester without
+drawing any graphs.
+
+Specifically, for each measurement file, report packet loss (split into
+network loss and packets dropped by the receiving host's own socket, where the
+file records drop counters), latency percentiles (both raw and, where the file
+records them, corrected for the sender falling behind its schedule),
+reordering (RFC 4737 reorder extents and RFC 5236 displacements, and the
+reorder buffer needed to put a given percentage of late packets back in order)
+and consecutive drop statistics as JSON or Markdown. matplotlib is never
+imported, so this is suitable for headless hosts and for summarising large
+numbers of files.
+
+With --from_sketches, only the '.sketch' summary saved next to each file is
+read, so memory use doesn't depend on the number of packets however many hosts
+or runs are merged. (Percentiles are then accurate to within about 1%, and
+consecutive drop statistics only count lost packets, not delayed ones.
+Reordering can't be recovered from a sketch.)
+"""
+
+from __future__ import print_function, division
+import argparse
+import json
+import os.path
+import numpy as np
+import graph_common
+
+description = """Summarise latency measurements made by packet_latency_tester.
+Report packet loss, latency percentiles, reordering and consecutive drop
+statistics for each file, as JSON or as a Markdown table."""
+
+DEFAULT_PERCENTILES = [50, 90, 99, 99.9]
+DEFAULT_REORDER_COVERAGES = [90, 99, 99.9, 100]
+# Must match latencysketch.SKETCH_FILENAME_SUFFIX (the analysis scripts don't
+# import the measurement code, so it's repeated here)
+SKETCH_FILENAME_SUFFIX = '.sketch'
+
+
+def parse_args():
+    """
+    Parse arguments.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        "measurement_filenames",
+        nargs='+',
+        help='One or more latency measurement files produced by packet_latency_tester'
+    )
+    parser.add_argument(
+        "--cutoff_time_ms",
+        type=int,
+        default=10,
+        help='The latency beyond which packets are considered delayed')
+    parser.add_argument(
+        "--percentiles",
+        type=float,
+        nargs='+',
+        default=DEFAULT_PERCENTILES,
+        help='Latency percentiles to report')
+    parser.add_argument(
+        "--reorder_coverage",
+        type=float,
+        nargs='+',
+        default=DEFAULT_REORDER_COVERAGES,
+        help='Report the reorder buffer needed to put these percentages of '
+             'out-of-order packets back in order')
+    parser.add_argument(
+        "--merge_all_files",
+        action='store_true',
+        help='Merge packet latencies from all files into a single summary')
+    parser.add_argument(
+        "--fast",
+        action='store_true',
+        help="Don't calculate statistics which take a while to compute")
+    parser.add_argument(
+        "--from_sketches",
+        action='store_true',
+        help="Summarise from the files' .sketch summaries instead of the raw latencies")
+    parser.add_argument(
+        "--format",
+        choices=['json', 'markdown'],
+        default='json')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Summarise each measurement file and print the summaries in the requested
+    format.
+    """
+    args = parse_args()
+
+    if args.from_sketches:
+        summaries = summarise_sketches(args.measurement_filenames,
+                                       args.cutoff_time_ms, args.percentiles,
+                                       args.merge_all_files)
+    else:
+        summaries = summarise_files(args.measurement_filenames,
+                                    args.cutoff_time_ms, args.percentiles,
+                                    args.merge_all_files, args.fast,
+                                    args.reorder_coverage)
+
+    if args.format == 'json':
+        print(json.dumps(summaries, indent=2))
+    else:
+        print(format_markdown(summaries, args.percentiles))
+
+
+def summarise_files(measurement_filenames, cutoff_time_ms, percentiles,
+                    merge_all_files, skip_slow_analyses,
+                    reorder_coverage_pcts=DEFAULT_REORDER_COVERAGES):
+    """
+    Summarise measurement files from the raw latencies they contain.
+    """
+    data_all_files = graph_common.read_latencies_files(measurement_filenames)
+    corrected_all_files = [graph_common.read_corrected_latencies_file(path)
+                           for path in measurement_filenames]
+    if merge_all_files:
+        data_all_files = graph_common.merge_all_hosts(data_all_files)
+        if any(corrected is None for corrected in corrected_all_files):
+            corrected_all_files = [None]
+        else:
+            corrected_all_files = [np.concatenate(corrected_all_files)]
+        # Drop counters are per-socket, so don't try to combine them
+        metadata_all_files = [{}]
+        # Nor does arrival order mean anything across files, and packet
+        # numbers repeat, so neither reordering nor consecutive drops can be
+        # worked out from the merged packets
+        reorder_coverage_pcts = None
+        skip_slow_analyses = True
+    else:
+        metadata_all_files = [graph_common.read_latencies_file_metadata(path)
+                              for path in measurement_filenames]
+
+    summaries = []
+    for ((filename, packet_ns, latencies_ms, total_n_packets),
+         corrected_latencies_ms, metadata) in zip(
+             data_all_files, corrected_all_files, metadata_all_files):
+        summary = summarise(packet_ns, latencies_ms, total_n_packets,
+                            cutoff_time_ms, percentiles, skip_slow_analyses,
+                            metadata, corrected_latencies_ms,
+                            reorder_coverage_pcts)
+        summary['filename'] = filename
+        summaries.append(summary)
+    return summaries
+
+
+def summarise_sketches(measurement_filenames, cutoff_time_ms, percentiles,
+                       merge_all_files):
+    """
+    Summarise measurement files from their sketches alone.
+    """
+    sketch_filenames = [
+        path if path.endswith(SKETCH_FILENAME_SUFFIX)
+        else path + SKETCH_FILENAME_SUFFIX for path in measurement_filenames]
+    filenames = [os.path.basename(path) for path in sketch_filenames]
+
+    if merge_all_files:
+        sketches = [graph_common.merge_sketches(
+            [graph_common.read_sketch_file(path) for path in sketch_filenames])]
+        filenames = [', '.join(filenames)]
+    else:
+        sketches = [graph_common.read_sketch_file(path)
+                    for path in sketch_filenames]
+
+    summaries = []
+    for (filename, sketch) in zip(filenames, sketches):
+        summary = stats_to_dict(
+            graph_common.calc_sketch_statistics(sketch, cutoff_time_ms))
+        summary['total_n_packets'] = sketch['n_packets_expected']
+        summary['n_received'] = sketch['n_packets_received']
+        summary['cutoff_time_ms'] = cutoff_time_ms
+        values = graph_common.sketch_percentiles_ms(sketch, percentiles)
+        summary['latency_percentiles_ms'] = dict(
+            (format_percentile(p), v) for (p, v) in zip(percentiles, values))
+        if sketch['corrected_bucket_counts']:
+            values = graph_common.sketch_percentiles_ms(sketch, percentiles,
+                                                        corrected=True)
+            summary['corrected_latency_percentiles_ms'] = dict(
+                (format_percentile(p), v)
+                for (p, v) in zip(percentiles, values))
+        summary['filename'] = filename
+        summaries.append(summary)
+    return summaries
+
+
+def summarise(packet_ns, latencies_ms, total_n_packets, cutoff_time_ms,
+              percentiles, skip_slow_analyses, metadata,
+              corrected_latencies_ms=None, reorder_coverage_pcts=None):
+    """
+    Calculate summary statistics for one set of measurements, returned as a
+    dictionary.
+
+    If corrected_latencies_ms (latencies measured from each packet's scheduled
+    send time) are given, their percentiles are reported too: unlike the raw
+    latencies, these include any time the sender spent behind schedule.
+
+    If reorder_coverage_pcts is given, packet_ns must be in order of arrival,
+    and reordering statistics are reported, including the reorder buffer
+    needed to put each of those percentages of out-of-order packets back in
+    order.
+    """
+    packet_ns = np.array(packet_ns)
+    latencies_ms = np.array(latencies_ms)
+
+    basicStats = graph_common.calc_basic_statistics(
+        packet_ns, latencies_ms, total_n_packets, cutoff_time_ms,
+        verbose=False)
+    summary = stats_to_dict(basicStats)
+    summary['total_n_packets'] = total_n_packets
+    summary['n_received'] = len(packet_ns)
+    summary['cutoff_time_ms'] = cutoff_time_ms
+
+    localDropStats = graph_common.calc_local_drop_statistics(
+        basicStats.n_totally_dropped, total_n_packets, metadata)
+    if localDropStats is not None:
+        summary.update(stats_to_dict(localDropStats))
+
+    summary['latency_percentiles_ms'] = calc_percentiles(latencies_ms,
+                                                         percentiles)
+    if corrected_latencies_ms is not None:
+        summary['corrected_latency_percentiles_ms'] = calc_percentiles(
+            corrected_latencies_ms, percentiles)
+    if 'n_schedule_misses' in metadata:
+        summary['n_schedule_misses'] = metadata['n_schedule_misses']
+    elif 'n_received_schedule_misses' in metadata:
+        # Only counts late packets which weren't then lost
+        summary['n_received_schedule_misses'] = \
+            metadata['n_received_schedule_misses']
+
+    if reorder_coverage_pcts is not None:
+        reorder_extents = graph_common.calc_reorder_extents(packet_ns)
+        displacements = graph_common.calc_reorder_displacements(packet_ns)
+        reorderingStats = graph_common.calc_reordering_statistics(
+            packet_ns, verbose=False, reorder_extents=reorder_extents,
+            displacements=displacements)
+        summary.update(stats_to_dict(reorderingStats))
+        summary['reorder_extent_counts'] = \
+            graph_common.count_values(reorder_extents)
+        summary['reorder_displacement_counts'] = graph_common.count_values(
+            displacements[displacements != 0])
+        buffer_sizes = graph_common.calc_reorder_buffer_sizes(
+            reorder_extents, reorder_coverage_pcts)
+        summary['reorder_buffer_packets'] = dict(
+            (format_percentile(pct), size)
+            for (pct, size) in zip(reorder_coverage_pcts, buffer_sizes))
+
+    if not skip_slow_analyses and len(packet_ns) > 0:
+        consecutiveStats = graph_common.calc_consecutive_drop_statistics(
+            packet_ns, latencies_ms, total_n_packets, cutoff_time_ms,
+            verbose=False)
+        summary.update(stats_to_dict(consecutiveStats))
+
+    return summary
+
+
+def calc_percentiles(latencies_ms, percentiles):
+    """
+    Calculate latency percentiles, returned as a dictionary keyed by
+    percentile label.
+    """
+    if len(latencies_ms) > 0:
+        values = np.percentile(latencies_ms, percentiles)
+    else:
+        values = [float('nan')] * len(percentiles)
+    return dict(
+        (format_percentile(p), float(v)) for (p, v) in zip(percentiles, values))
+
+
+def stats_to_dict(stats):
+    """
+    Convert one of graph_common's statistics namedtuples to a plain dictionary
+    of JSON-serialisable values (converting numpy scalars to the equivalent
+    Python int or float, so that counts stay integers).
+    """
+    return dict((k, v.item() if isinstance(v, np.generic) else v)
+                for (k, v) in stats._asdict().items())
+
+
+def format_percentile(percentile):
+    """
+    Format a percentile as a short label, e.g. 99.0 => 'p99', 99.9 => 'p99.9'.
+    """
+    return 'p%g' % percentile
+
+
+def format_markdown(summaries, percentiles):
+    """
+    Format summaries as a Markdown table, one row per file.
+    """
+    percentile_labels = [format_percentile(p) for p in percentiles]
+    columns = ['File', 'Packets', 'Dropped (%)', 'Network/local drops (%)',
+               'Dropped or delayed (%)']
+    columns += ['%s (ms)' % label for label in percentile_labels]
+    any_corrected = any('corrected_latency_percentiles_ms' in summary
+                        for summary in summaries)
+    if any_corrected:
+        columns += ['Corrected %s (ms)' % label for label in percentile_labels]
+        columns += ['Schedule misses']
+    columns += ['Reordered (%)', 'Max reorder extent', 'Consecutive drops (%)']
+
+    lines = []
+    lines.append('| ' + ' | '.join(columns) + ' |')
+    lines.append('|' + '---|' * len(columns))
+    for summary in summaries:
+        row = [summary['filename'],
+               '%d/%d' % (summary['n_received'], summary['total_n_packets']),
+               '%.1f' % summary['pct_totally_dropped']]
+        if 'pct_network_dropped' in summary:
+            row.append('%.1f/%.1f' % (summary['pct_network_dropped'],
+                                      summary['pct_local_overflow_dropped']))
+        else:
+            row.append('-')
+        row.append('%.1f' % summary['pct_dropped_or_beyond_cutoff'])
+        row += ['%.2f' % summary['latency_percentiles_ms'][label]
+                for label in percentile_labels]
+        if any_corrected:
+            if 'corrected_latency_percentiles_ms' in summary:
+                row += ['%.2f' % summary['corrected_latency_percentiles_ms'][label]
+                        for label in percentile_labels]
+            else:
+                row += ['-'] * len(percentile_labels)
+            if 'n_schedule_misses' in summary:
+                row.append(str(summary['n_schedule_misses']))
+            elif 'n_received_schedule_misses' in summary:
+                row.append('%d (of received)' %
+                           summary['n_received_schedule_misses'])
+            else:
+                row.append('-')
+        if 'pct_reordered' in summary:
+            row.append('%.1f' % summary['pct_reordered'])
+            row.append('%d' % summary['max_reorder_extent'])
+        else:
+            row += ['-', '-']
+        if 'pct_consecutive_drops_resorted' in summary:
+            row.append('%.1f' % summary['pct_consecutive_drops_resorted'])
+        elif 'pct_consecutive_losses' in summary:
+            row.append('%.1f' % summary['pct_consecutive_losses'])
+        else:
+            row.append('-')
+        lines.append('| ' + ' | '.join(row) + ' |')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+"""
+Query a results store (the SQLite database written by echo.py/quack.py with
+--results_db) for loss and latency percentile trends across many runs.
+
+Only the per-run summaries calculated when each run was saved are read, so
+queries stay fast however many runs (and packets) the store holds.
+"""
+
+from __future__ import print_function, division
+import argparse
+import datetime
+import json
+import sqlite3
+
+description = """Query loss and latency percentile trends from a results store.
+Lists matching runs in the order they were saved, or with --group_by,
+aggregates them by run parameters."""
+
+# Columns which can be filtered on and grouped by
+PARAM_COLUMNS = ['measurement', 'host', 'target', 'traffic_profile',
+                 'payload_len', 'send_rate_kBps']
+
+# Per-run columns to show, and how to aggregate them when grouping
+SUMMARY_COLUMNS = [('loss_pct', 'AVG'), ('latency_p50_us', 'AVG'),
+                   ('latency_p90_us', 'AVG'), ('latency_p99_us', 'AVG'),
+                   ('latency_p99_9_us', 'AVG'), ('latency_max_us', 'MAX')]
+
+
+def parse_args():
+    """
+    Parse arguments.
+    """
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("results_db", help='The results store to query')
+    for column in PARAM_COLUMNS:
+        parser.add_argument(
+            "--%s" % column,
+            help='Only include runs with this %s' % column)
+    parser.add_argument(
+        "--since",
+        help='Only include runs saved since this date/time (ISO 8601)')
+    parser.add_argument(
+        "--until",
+        help='Only include runs saved before this date/time (ISO 8601)')
+    parser.add_argument(
+        "--group_by",
+        nargs='+',
+        choices=PARAM_COLUMNS,
+        help='Aggregate runs with the same values of these parameters')
+    parser.add_argument(
+        "--format",
+        choices=['json', 'markdown'],
+        default='markdown')
+    return parser.parse_args()
+
+
+def main():
+    """
+    Run the query specified by command-line arguments and print the results.
+    """
+    args = parse_args()
+
+    conditions = []
+    values = []
+    for column in PARAM_COLUMNS:
+        value = getattr(args, column)
+        if value is not None:
+            conditions.append("%s = ?" % column)
+            values.append(value)
+    if args.since is not None:
+        conditions.append("saved_at >= ?")
+        values.append(parse_time(args.since))
+    if args.until is not None:
+        conditions.append("saved_at < ?")
+        values.append(parse_time(args.until))
+    where = ("WHERE " + " AND ".join(conditions)) if conditions else ""
+
+    if args.group_by:
+        group_columns = args.group_by
+        columns = group_columns + ['COUNT(*) AS n_runs',
+                                   'MIN(saved_at) AS first_saved_at',
+                                   'MAX(saved_at) AS last_saved_at']
+        columns += ["%s(%s) AS %s" % (aggregate, column, column)
+                    for (column, aggregate) in SUMMARY_COLUMNS]
+        query = "SELECT %s FROM runs %s GROUP BY %s ORDER BY %s" % (
+            ', '.join(columns), where, ', '.join(group_columns),
+            ', '.join(group_columns))
+    else:
+        columns = ['run_id', 'saved_at'] + PARAM_COLUMNS
+        columns += ['n_packets_expected', 'n_packets_received']
+        columns += [column for (column, _) in SUMMARY_COLUMNS]
+        query = "SELECT %s FROM runs %s ORDER BY saved_at" % (
+            ', '.join(columns), where)
+
+    connection = sqlite3.connect(args.results_db)
+    connection.row_factory = sqlite3.Row
+    rows = [dict(row) for row in connection.execute(query, values)]
+    connection.close()
+
+    for row in rows:
+        for key in ['saved_at', 'first_saved_at', 'last_saved_at']:
+            if key in row:
+                row[key] = format_time(row[key])
+
+    if args.format == 'json':
+        print(json.dumps(rows, indent=2))
+    else:
+        print(format_markdown(rows))
+
+
+def parse_time(time_string):
+    """
+    Convert an ISO 8601 date/time (in local time) to a Unix timestamp.
+    """
+    return datetime.datetime.strptime(
+        time_string, '%Y-%m-%dT%H:%M:%S' if 'T' in time_string else
+        '%Y-%m-%d').timestamp()
+
+
+def format_time(timestamp):
+    return datetime.datetime.fromtimestamp(timestamp).isoformat(
+        sep=' ', timespec='seconds')
+
+
+def format_markdown(rows):
+    """
+    Format query results as a Markdown table.
+    """
+    if len(rows) == 0:
+        return "No matching runs"
+    columns = list(rows[0].keys())
+    lines = []
+    lines.append('| ' + ' | '.join(columns) + ' |')
+    lines.append('|' + '---|' * len(columns))
+    for row in rows:
+        cells = []
+        for column in columns:
+            value = row[column]
+            if value is None:
+                cells.append('-')
+            elif isinstance(value, float):
+                cells.append('%.2f' % value)
+            else:
+                cells.append(str(value))
+        lines.append('| ' + ' | '.join(cells) + ' |')
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    main()
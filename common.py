@@ -4,6 +4,9 @@ the program main() function, and argument parsing.
 """
 
 import argparse
+import sys
+import trafficprofile
+import tuning
 
 SERVER_RECV_BUFFER_SIZE = 4096
 
@@ -15,18 +18,84 @@ def main(Measurement):
 
     args = parse_args(Measurement.description)
 
-    if args.payload_len > SERVER_RECV_BUFFER_SIZE:
-        print("Warning: payload_len (%d) is greater than "
-              "SERVER_RECV_BUFFER_SIZE (%d)" % (args.payload_len,
-                                                SERVER_RECV_BUFFER_SIZE))
+    if args.client:
+        profile = trafficprofile.from_args(args)
+        if profile.max_packet_len() > SERVER_RECV_BUFFER_SIZE:
+            print("Warning: packet length (%d) is greater than "
+                  "SERVER_RECV_BUFFER_SIZE (%d)" % (profile.max_packet_len(),
+                                                    SERVER_RECV_BUFFER_SIZE))
 
-    tester = Measurement(args.output_filename)
+    tester = Measurement(args.output_filename, client_id=args.client_id,
+                         n_clients=args.n_clients,
+                         client_timeout_seconds=args.client_timeout_seconds,
+                         rcvbuf_bytes=args.rcvbuf_bytes,
+                         sndbuf_bytes=args.sndbuf_bytes,
+                         single_process=args.single_process,
+                         reply_to_source=args.reply_to_source,
+                         counter_resync_seconds=args.counter_resync_ms / 1000,
+                         results_db=args.results_db,
+                         run_params=run_params(args),
+                         tuning_options=tuning_options(args))
     if args.server:
         tester.run_server(args.listen_port, SERVER_RECV_BUFFER_SIZE)
     elif args.client:
-        target_address = (args.client, args.listen_port)
-        tester.run_client(target_address, args.n_packets, args.payload_len,
-                          args.send_rate_kBps)
+        target_addresses = parse_targets(args.client, args.listen_port)
+        if len(target_addresses) == 1:
+            tester.run_client(target_addresses[0], profile)
+        elif hasattr(tester, 'run_client_mesh'):
+            tester.run_client_mesh(target_addresses, profile)
+        else:
+            sys.exit("Error: this measurement only supports one --client target")
+
+def parse_targets(targets, default_port):
+    """
+    Parse a comma-separated list of HOST or HOST:PORT targets into a list of
+    (host, port) addresses.
+    """
+    target_addresses = []
+    for target in targets.split(','):
+        if ':' in target:
+            (host, port) = target.rsplit(':', 1)
+            target_addresses.append((host, int(port)))
+        else:
+            target_addresses.append((target, default_port))
+    return target_addresses
+
+def tuning_options(args):
+    """
+    Collect the process/socket tuning options from the command-line arguments.
+    """
+    cpus = {'sender': args.sender_cpu, 'receiver': args.receiver_cpu,
+            'server': args.server_cpu}
+    return tuning.TuningOptions(
+        cpus=dict((role, cpu) for (role, cpu) in cpus.items()
+                  if cpu is not None),
+        fifo_priority=args.sched_fifo, lock_memory=args.mlockall,
+        busy_poll_us=args.busy_poll_us, spin_recv=args.spin_recv)
+
+def run_params(args):
+    """
+    Return the parameters of a client's run which are worth recording
+    alongside its results.
+    """
+    if not args.client:
+        return {}
+    params = {'target': ','.join(
+                  "%s:%d" % target_address for target_address
+                  in parse_targets(args.client, args.listen_port)),
+              'traffic_profile': args.traffic_profile}
+    if args.traffic_profile == 'trace':
+        params['trace_filename'] = args.trace_filename
+    else:
+        params.update({'n_packets': args.n_packets,
+                       'payload_len': args.payload_len,
+                       'send_rate_kBps': args.send_rate_kBps})
+    if args.traffic_profile == 'on_off':
+        params.update({'mean_on_ms': args.mean_on_ms,
+                       'mean_off_ms': args.mean_off_ms})
+    if args.seed is not None:
+        params['seed'] = args.seed
+    return params
 
 def parse_args(description):
     """
@@ -37,13 +106,95 @@ def parse_args(description):
         description=description, formatter_class=argparse.RawTextHelpFormatter)
     group = parser.add_mutually_exclusive_group(required=True)
     group.add_argument('--server', action='store_true')
-    group.add_argument('--client')
+    group.add_argument(
+        '--client',
+        help="Server to send packets to, as HOST or HOST:PORT (default port:\n"
+             "--listen_port). echo.py can probe several servers at once from\n"
+             "one event loop, given as a comma-separated list; each must be\n"
+             "run with --reply_to_source")
     parser.add_argument("--n_packets", type=int, default=100)
     parser.add_argument("--payload_len", type=int, default=256)
     parser.add_argument("--send_rate_kBps", type=int, default=400)
     parser.add_argument(
         "--output_filename", default='udp_packetn_latency_pairs')
     parser.add_argument("--listen_port", type=int, default=8888)
+    parser.add_argument(
+        "--traffic_profile", choices=['cbr', 'poisson', 'on_off', 'trace'],
+        default='cbr',
+        help="(Client) When to send packets:\n"
+             "  cbr:     at a constant rate\n"
+             "  poisson: with exponentially-distributed gaps\n"
+             "  on_off:  in constant-rate bursts (see --mean_on_ms/--mean_off_ms)\n"
+             "  trace:   replaying --trace_filename (ignoring --n_packets,\n"
+             "           --payload_len and --send_rate_kBps)")
+    parser.add_argument(
+        "--mean_on_ms", type=float, default=trafficprofile.DEFAULT_MEAN_ON_MS,
+        help="(Client) Mean burst length for --traffic_profile on_off")
+    parser.add_argument(
+        "--mean_off_ms", type=float, default=trafficprofile.DEFAULT_MEAN_OFF_MS,
+        help="(Client) Mean gap between bursts for --traffic_profile on_off")
+    parser.add_argument(
+        "--trace_filename",
+        help="(Client) File of '<send time (s)> <packet length>' lines to\n"
+             "replay with --traffic_profile trace")
+    parser.add_argument(
+        "--seed", type=int,
+        help="(Client) Random seed for the poisson and on_off traffic profiles")
+    parser.add_argument(
+        "--results_db",
+        help="Also add results to this SQLite results store\n"
+             "(see analysis/query_results.py)")
+    parser.add_argument(
+        "--client_id",
+        help="(Client) ID identifying this client to the server "
+             "(default: hostname)")
+    parser.add_argument(
+        "--n_clients", type=int,
+        help="(Server) Stop once this many clients have finished\n"
+             "(default: stop once no new clients have turned up for\n"
+             "--client_timeout_seconds)")
+    parser.add_argument(
+        "--client_timeout_seconds", type=float, default=15,
+        help="(Server) Give up on a client after this many seconds of silence")
+    parser.add_argument(
+        "--rcvbuf_bytes", type=int,
+        help="Socket receive buffer size to request (default: system default)")
+    parser.add_argument(
+        "--sndbuf_bytes", type=int,
+        help="Socket send buffer size to request (default: system default)")
+    parser.add_argument(
+        "--single_process", action='store_true',
+        help="(echo.py client) Send and receive from one event loop on a\n"
+             "single socket (requires a server run with --reply_to_source)")
+    parser.add_argument(
+        "--reply_to_source", action='store_true',
+        help="(echo.py server) Send replies back to the port they came from\n"
+             "rather than to listen_port + 1")
+    parser.add_argument(
+        "--sender_cpu", type=int,
+        help="Pin the sending process (or the single-process client) to this CPU")
+    parser.add_argument(
+        "--receiver_cpu", type=int,
+        help="(echo.py client) Pin the receiving process to this CPU")
+    parser.add_argument(
+        "--server_cpu", type=int, help="Pin the server process to this CPU")
+    parser.add_argument(
+        "--sched_fifo", type=int, metavar='PRIORITY',
+        help="Run with SCHED_FIFO real-time scheduling at this priority")
+    parser.add_argument(
+        "--mlockall", action='store_true',
+        help="Lock all memory to avoid page faults")
+    parser.add_argument(
+        "--busy_poll_us", type=int,
+        help="Set SO_BUSY_POLL on receive sockets to this many microseconds")
+    parser.add_argument(
+        "--spin_recv", action='store_true',
+        help="Busy-wait for packets instead of sleeping until they arrive")
+    parser.add_argument(
+        "--counter_resync_ms", type=float, default=0,
+        help="(quack.py) Only read the hardware counter this often,\n"
+             "extrapolating from the host clock in between (default: read\n"
+             "it for every packet)")
     args = parser.parse_args()
     return args
 
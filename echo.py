@@ -18,6 +18,11 @@ The client-mode script outputs a plain text list of packet number/round-trip
 latency (in milliseconds) tuples for each packet received, one per line. The
 first line of the file specifies the number of packets sent, enabling
 calculation of the number of packets that got lost along the way.
+
+(With --single_process, the client instead sends and receives from a single
+event loop on one socket; the server must then be run with --reply_to_source.
+Given a comma-separated list of servers, the client probes them all
+concurrently in the same way.)
 """
 
 import common
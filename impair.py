@@ -0,0 +1,20 @@
+#!/usr/bin/env python3
+
+"""
+Relay UDP packets between an echo.py/quack.py client and server, injecting
+delay, jitter, loss (independent or Gilbert-Elliott bursts), reordering and
+rate limiting on the way.
+
+Run the server on some other port, run this script listening on the port the
+client will send to, and point the client at this script's host. Given a seed,
+impairments are reproducible from run to run, and with --ground_truth_filename
+the fate of every packet is logged for comparison with the measured results.
+
+Round-trip measurements need the server to reply to the address packets come
+from, i.e. echo.py --server --reply_to_source with echo.py --client
+--single_process.
+"""
+
+import impairment
+
+impairment.main()
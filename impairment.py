@@ -0,0 +1,311 @@
+"""
+A user-space UDP relay which impairs the packets passing through it (delay,
+jitter, loss, reordering and rate limiting), for testing the measurement and
+analysis code against known network conditions on a single machine.
+
+All random decisions come from seeded random number generators, so the same
+seed and the same packets give the same impairments every time. Each decision
+can be logged to a ground-truth file for comparison with what the measurement
+tools report.
+"""
+
+from __future__ import division
+import argparse
+import heapq
+import random
+import selectors
+import socket
+import time
+
+DELAY_DISTRIBUTIONS = ['constant', 'uniform', 'normal', 'exponential']
+RECV_BUFFER_SIZE = 65536
+
+class Impairment:
+    """
+    Decide what happens to each packet travelling in one direction.
+
+    Loss follows a Gilbert-Elliott model: a 'good' state with loss probability
+    loss_good and a 'bad' state with loss probability loss_bad, moving from
+    good to bad with probability ge_p and from bad to good with probability
+    ge_r after each packet. With ge_p = 0 this is just independent loss with
+    probability loss_good.
+
+    Each surviving packet is delayed by delay_ms plus jitter drawn from
+    delay_distribution (with spread jitter_ms), after waiting for the link to
+    be free if rate_kbytes_per_s is set. Packets are delivered in order unless
+    picked for reordering (with probability reorder), in which case they are
+    held back by an extra reorder_delay_ms and may be overtaken.
+    """
+
+    def __init__(self, rng, delay_ms=0, jitter_ms=0,
+                 delay_distribution='constant', loss_good=0, loss_bad=1,
+                 ge_p=0, ge_r=1, reorder=0, reorder_delay_ms=10,
+                 rate_kbytes_per_s=None):
+        if delay_distribution not in DELAY_DISTRIBUTIONS:
+            raise ValueError("Unknown delay distribution '%s'" %
+                             delay_distribution)
+        self.rng = rng
+        self.delay_seconds = delay_ms / 1000
+        self.jitter_seconds = jitter_ms / 1000
+        self.delay_distribution = delay_distribution
+        self.loss_good = loss_good
+        self.loss_bad = loss_bad
+        self.ge_p = ge_p
+        self.ge_r = ge_r
+        self.reorder = reorder
+        self.reorder_delay_seconds = reorder_delay_ms / 1000
+        self.rate_bytes_per_s = \
+            None if rate_kbytes_per_s is None else rate_kbytes_per_s * 1000
+
+        self.bad_state = False
+        self.link_free_seconds = 0
+        self.last_delivery_seconds = 0
+
+    def sample_delay(self):
+        """
+        Draw one packet's propagation delay (in seconds).
+        """
+        if self.delay_distribution == 'constant':
+            delay = self.delay_seconds
+        elif self.delay_distribution == 'uniform':
+            delay = self.rng.uniform(self.delay_seconds - self.jitter_seconds,
+                                     self.delay_seconds + self.jitter_seconds)
+        elif self.delay_distribution == 'normal':
+            delay = self.rng.gauss(self.delay_seconds, self.jitter_seconds)
+        else:
+            delay = self.delay_seconds
+            if self.jitter_seconds > 0:
+                delay += self.rng.expovariate(1 / self.jitter_seconds)
+        return max(delay, 0)
+
+    def process(self, now_seconds, packet_len):
+        """
+        Decide the fate of one packet arriving at now_seconds. Returns a
+        (delivery time, reordered) tuple, or None if the packet is dropped.
+        """
+        loss = self.loss_bad if self.bad_state else self.loss_good
+        if self.bad_state:
+            self.bad_state = self.rng.random() >= self.ge_r
+        else:
+            self.bad_state = self.rng.random() < self.ge_p
+        if self.rng.random() < loss:
+            return None
+
+        send_seconds = now_seconds
+        if self.rate_bytes_per_s is not None:
+            send_seconds = max(now_seconds, self.link_free_seconds)
+            send_seconds += packet_len / self.rate_bytes_per_s
+            self.link_free_seconds = send_seconds
+
+        delivery_seconds = send_seconds + self.sample_delay()
+        reordered = self.rng.random() < self.reorder
+        if reordered:
+            delivery_seconds += self.reorder_delay_seconds
+        else:
+            # Jitter alone doesn't reorder packets
+            delivery_seconds = max(delivery_seconds, self.last_delivery_seconds)
+            self.last_delivery_seconds = delivery_seconds
+        return (delivery_seconds, reordered)
+
+class ImpairmentProxy:
+    """
+    Relay packets from clients arriving on listen_port to target_address, and
+    replies from target_address back to the client they're for, impairing
+    both directions.
+
+    Each client gets its own upstream socket so that replies can be matched up
+    with clients; the server should reply to the address packets came from
+    (i.e. echo.py --server --reply_to_source).
+    """
+
+    def __init__(self, listen_port, target_address, forward_impairment,
+                 reverse_impairment, ground_truth_filename=None):
+        self.listen_port = listen_port
+        self.target_address = target_address
+        self.impairments = {'f': forward_impairment, 'r': reverse_impairment}
+        self.ground_truth_filename = ground_truth_filename
+
+    def run(self):
+        """
+        Relay packets until interrupted.
+        """
+        sock_down = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock_down.bind(("0.0.0.0", self.listen_port))
+        selector = selectors.DefaultSelector()
+        selector.register(sock_down, selectors.EVENT_READ)
+
+        upstream_socks = {}
+        upstream_clients = {}
+        pending = []
+        n_packets = {'f': 0, 'r': 0}
+        n_dropped = {'f': 0, 'r': 0}
+        ground_truth_file = None
+        if self.ground_truth_filename is not None:
+            ground_truth_file = open(self.ground_truth_filename, 'w')
+            ground_truth_file.write(
+                "# direction seq packet_len dropped delay_us reordered\n")
+
+        print("Relaying packets from port %d to %s:%d..." %
+              ((self.listen_port, ) + tuple(self.target_address)))
+
+        try:
+            while True:
+                if pending:
+                    timeout_seconds = max(pending[0][0] - time.monotonic(), 0)
+                else:
+                    timeout_seconds = None
+
+                for (key, _) in selector.select(timeout_seconds):
+                    sock = key.fileobj
+                    try:
+                        (data, addr) = sock.recvfrom(RECV_BUFFER_SIZE)
+                    except ConnectionRefusedError:
+                        # ICMP port unreachable from an earlier packet relayed
+                        # upstream; nothing listening at the other end (yet)
+                        continue
+                    now_seconds = time.monotonic()
+
+                    if sock is sock_down:
+                        direction = 'f'
+                        sock_up = upstream_socks.get(addr)
+                        if sock_up is None:
+                            sock_up = socket.socket(socket.AF_INET,
+                                                    socket.SOCK_DGRAM)
+                            sock_up.connect(self.target_address)
+                            selector.register(sock_up, selectors.EVENT_READ)
+                            upstream_socks[addr] = sock_up
+                            upstream_clients[sock_up] = addr
+                        destination = (sock_up, None)
+                    else:
+                        direction = 'r'
+                        destination = (sock_down, upstream_clients[sock])
+
+                    seq = n_packets[direction]
+                    n_packets[direction] += 1
+                    fate = self.impairments[direction].process(now_seconds,
+                                                               len(data))
+                    if fate is None:
+                        n_dropped[direction] += 1
+                    else:
+                        (delivery_seconds, reordered) = fate
+                        heapq.heappush(pending, (delivery_seconds, direction,
+                                                 seq, destination, data))
+
+                    if ground_truth_file is not None:
+                        if fate is None:
+                            ground_truth_file.write("%s %d %d 1 - -\n" % (
+                                direction, seq, len(data)))
+                        else:
+                            ground_truth_file.write("%s %d %d 0 %d %d\n" % (
+                                direction, seq, len(data),
+                                (delivery_seconds - now_seconds) * 1e6,
+                                reordered))
+
+                now_seconds = time.monotonic()
+                while pending and pending[0][0] <= now_seconds:
+                    (_, _, _, (sock, addr), data) = heapq.heappop(pending)
+                    try:
+                        if addr is None:
+                            sock.send(data)
+                        else:
+                            sock.sendto(data, addr)
+                    except ConnectionRefusedError:
+                        # Nothing listening at the other end (yet)
+                        pass
+        except KeyboardInterrupt:
+            pass
+
+        print("Closing...")
+        for direction in ['f', 'r']:
+            print("%s: relayed %d packets, dropped %d" % (
+                {'f': 'Forward', 'r': 'Reverse'}[direction],
+                n_packets[direction] - n_dropped[direction],
+                n_dropped[direction]))
+        if ground_truth_file is not None:
+            ground_truth_file.close()
+        for sock in upstream_socks.values():
+            sock.close()
+        selector.close()
+        sock_down.close()
+
+def main():
+    """
+    Process arguments and run the proxy.
+    """
+    args = parse_args()
+
+    target_host, target_port = args.target.rsplit(':', 1)
+    target_address = (target_host, int(target_port))
+
+    impairments = []
+    for seed_offset in [0, 1]:
+        # Separate generators for each direction, so that e.g. the pattern of
+        # forward losses doesn't depend on how many replies there were
+        if args.seed is None:
+            rng = random.Random()
+        else:
+            rng = random.Random(args.seed + seed_offset)
+        impairments.append(Impairment(
+            rng, delay_ms=args.delay_ms, jitter_ms=args.jitter_ms,
+            delay_distribution=args.delay_distribution, loss_good=args.loss,
+            loss_bad=args.ge_loss_bad, ge_p=args.ge_p, ge_r=args.ge_r,
+            reorder=args.reorder, reorder_delay_ms=args.reorder_delay_ms,
+            rate_kbytes_per_s=args.rate_kBps))
+    if args.forward_only:
+        impairments[1] = Impairment(random.Random())
+
+    proxy = ImpairmentProxy(args.listen_port, target_address, impairments[0],
+                            impairments[1], args.ground_truth_filename)
+    proxy.run()
+
+def parse_args():
+    """
+    Parse arguments.
+    """
+    description = """Relay UDP packets between echo.py/quack.py clients and
+servers, impairing them on the way. For example, on one host:
+    $ ./echo.py --server --reply_to_source --listen_port 8889
+    $ ./impair.py --target 127.0.0.1:8889 --delay_ms 5 --jitter_ms 1 --loss 0.01 --seed 1
+    $ ./echo.py --client 127.0.0.1 --single_process"""
+    parser = argparse.ArgumentParser(
+        description=description, formatter_class=argparse.RawTextHelpFormatter)
+    parser.add_argument("--listen_port", type=int, default=8888)
+    parser.add_argument(
+        "--target", required=True,
+        help="Address of the server to relay packets to, as HOST:PORT")
+    parser.add_argument("--delay_ms", type=float, default=0)
+    parser.add_argument("--jitter_ms", type=float, default=0)
+    parser.add_argument(
+        "--delay_distribution", choices=DELAY_DISTRIBUTIONS, default='normal',
+        help="How jitter is distributed around --delay_ms\n"
+             "(exponential: --delay_ms plus an exponential with mean --jitter_ms)")
+    parser.add_argument(
+        "--loss", type=float, default=0,
+        help="Packet loss probability (in the 'good' state, if using\n"
+             "Gilbert-Elliott loss)")
+    parser.add_argument(
+        "--ge_p", type=float, default=0,
+        help="Gilbert-Elliott probability of moving from the good to the bad\n"
+             "state (default: 0, i.e. independent losses)")
+    parser.add_argument(
+        "--ge_r", type=float, default=1,
+        help="Gilbert-Elliott probability of moving from the bad to the good state")
+    parser.add_argument(
+        "--ge_loss_bad", type=float, default=1,
+        help="Packet loss probability in the Gilbert-Elliott bad state")
+    parser.add_argument(
+        "--reorder", type=float, default=0,
+        help="Probability of holding a packet back by --reorder_delay_ms")
+    parser.add_argument("--reorder_delay_ms", type=float, default=10)
+    parser.add_argument(
+        "--rate_kBps", type=float,
+        help="Limit throughput to this rate, queueing packets (default: no limit)")
+    parser.add_argument(
+        "--forward_only", action='store_true',
+        help="Only impair packets going from clients to the server")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument(
+        "--ground_truth_filename",
+        help="Log what happened to every packet to this file")
+    args = parser.parse_args()
+    return args
@@ -0,0 +1,107 @@
+"""
+A compact, mergeable summary ('sketch') of one run's results, written next to
+each latencies file as <latencies filename>.sketch.
+
+Latencies are counted in logarithmically-sized buckets, so any percentile can
+be recovered to within SKETCH_RELATIVE_ACCURACY whatever the range of
+latencies, and sketches from different runs or hosts can be merged just by
+adding up bucket counts. Packet loss and the lengths of bursts of consecutive
+lost packets are counted alongside. The size of a sketch depends only on the
+range of latencies seen, not on the number of packets.
+
+Where the results include latencies corrected to each packet's scheduled send
+time, those are counted in a second set of buckets with the same layout.
+
+The file is JSON, and describes its own bucket layout: bucket i counts
+latencies in (min_latency_us * growth^(i - 1), min_latency_us * growth^i],
+with bucket 0 also counting everything below min_latency_us.
+"""
+
+from __future__ import division
+import json
+import math
+
+SKETCH_FORMAT = 'ultra_ping latency sketch'
+SKETCH_VERSION = 2
+# (Repeated in analysis/latency_stats.py, so change both together)
+SKETCH_FILENAME_SUFFIX = '.sketch'
+SKETCH_MIN_LATENCY_US = 1
+SKETCH_RELATIVE_ACCURACY = 0.01
+
+class LatencySketch:
+
+    def __init__(self, min_latency_us=SKETCH_MIN_LATENCY_US,
+                 relative_accuracy=SKETCH_RELATIVE_ACCURACY):
+        self.min_latency_us = min_latency_us
+        # Reporting the geometric middle of each bucket keeps the error within
+        # relative_accuracy either side
+        self.growth = ((1 + relative_accuracy) / (1 - relative_accuracy))
+        self.log_growth = math.log(self.growth)
+        self.bucket_counts = {}
+        self.corrected_bucket_counts = {}
+        self.n_packets_expected = 0
+        self.n_packets_received = 0
+        self.loss_burst_lengths = {}
+
+    def bucket_index(self, latency_us):
+        if latency_us <= self.min_latency_us:
+            return 0
+        return int(math.ceil(math.log(latency_us / self.min_latency_us) /
+                             self.log_growth))
+
+    def add_run(self, packetn_latency_tuples, n_packets_expected):
+        """
+        Add the results of one run: the (packet number, latency) or (packet
+        number, latency, corrected latency) of each packet received, and the
+        number of packets sent.
+        """
+        received = bytearray(n_packets_expected)
+        for tup in packetn_latency_tuples:
+            (packet_n, latency_us) = tup[:2]
+            self.add_latency(self.bucket_counts, latency_us)
+            if len(tup) > 2:
+                self.add_latency(self.corrected_bucket_counts, tup[2])
+            self.n_packets_received += 1
+            if 0 <= packet_n < n_packets_expected:
+                received[packet_n] = 1
+        self.n_packets_expected += n_packets_expected
+
+        burst_length = 0
+        for packet_received in received:
+            if packet_received:
+                if burst_length > 0:
+                    self.add_loss_burst(burst_length)
+                burst_length = 0
+            else:
+                burst_length += 1
+        if burst_length > 0:
+            self.add_loss_burst(burst_length)
+
+    def add_latency(self, bucket_counts, latency_us):
+        index = self.bucket_index(latency_us)
+        bucket_counts[index] = bucket_counts.get(index, 0) + 1
+
+    def add_loss_burst(self, burst_length):
+        self.loss_burst_lengths[burst_length] = \
+            self.loss_burst_lengths.get(burst_length, 0) + 1
+
+    def to_dict(self):
+        return {
+            'format': SKETCH_FORMAT,
+            'version': SKETCH_VERSION,
+            'min_latency_us': self.min_latency_us,
+            'growth': self.growth,
+            'bucket_counts': dict((str(index), count) for (index, count)
+                                  in sorted(self.bucket_counts.items())),
+            'corrected_bucket_counts': dict(
+                (str(index), count) for (index, count)
+                in sorted(self.corrected_bucket_counts.items())),
+            'n_packets_expected': self.n_packets_expected,
+            'n_packets_received': self.n_packets_received,
+            'loss_burst_lengths': dict((str(length), count) for (length, count)
+                                       in sorted(self.loss_burst_lengths.items())),
+        }
+
+    def save(self, sketch_filename):
+        with open(sketch_filename, 'w') as sketch_file:
+            json.dump(self.to_dict(), sketch_file)
@@ -3,10 +3,15 @@ Interface with a hardware timer implemented as a counter on a ValentF(x) LOGI
 Pi FPGA board.
 """
 
+from __future__ import division
+import time
+import numpy as np
 import logi
 
 counter_timestep_us = 10
 max_counter_value = 65535
+# The counter wraps around to 0 after max_counter_value
+counter_modulus = max_counter_value + 1
 
 def read_counter():
     """
@@ -24,7 +29,7 @@ def counter_delta(counter_value_2, counter_value_1):
     delta = counter_value_2 - counter_value_1
     if delta < 0:
         # counter has wrapped around
-        delta += max_counter_value
+        delta += counter_modulus
     return delta
 
 def counter_delta_to_us(delta):
@@ -32,3 +37,66 @@ def counter_delta_to_us(delta):
     Convert a difference in counter values to a time difference.
     """
     return delta * counter_timestep_us
+
+class ExtendedCounter:
+    """
+    Extend the 16-bit hardware counter (which wraps every ~655 ms) into a
+    monotonically-increasing 64-bit tick count by keeping track of wraps.
+
+    Wraps are resolved using the host's monotonic clock: each new hardware
+    reading is placed in whichever wrap period is closest to where the host
+    clock says we should be, so reads don't have to be more frequent than once
+    per wrap period.
+
+    To save SPI transactions at high packet rates, the hardware counter is only
+    read if at least resync_interval_seconds have passed since the last read;
+    in between, ticks are extrapolated from the last read using the host clock.
+    With the default of 0, every call reads the hardware counter.
+    """
+
+    def __init__(self, resync_interval_seconds=0):
+        self.resync_interval_seconds = resync_interval_seconds
+        self.last_ticks = None
+        self.last_read_seconds = None
+
+    def read(self):
+        """
+        Return the current extended tick count.
+        """
+        now_seconds = time.monotonic()
+        if self.last_ticks is not None:
+            elapsed_ticks = int((now_seconds - self.last_read_seconds) * 1e6 /
+                                counter_timestep_us)
+            predicted_ticks = self.last_ticks + elapsed_ticks
+            if (now_seconds - self.last_read_seconds) < self.resync_interval_seconds:
+                return predicted_ticks
+
+        counter_value = read_counter()
+        if self.last_ticks is None:
+            ticks = counter_value
+        else:
+            n_wraps = round((predicted_ticks - counter_value) / counter_modulus)
+            ticks = counter_value + n_wraps * counter_modulus
+        self.last_ticks = ticks
+        self.last_read_seconds = now_seconds
+        return ticks
+
+def unwrap_counter_deltas(send_ticks, recv_ticks):
+    """
+    Calculate the number of ticks between sending and receiving each of a
+    batch of packets from one client, given the sender's and receiver's
+    extended tick counts.
+
+    The two hosts' ExtendedCounters started counting wraps at different times,
+    so their tick counts differ by an unknown multiple of counter_modulus. We
+    remove that offset by assuming that the quickest packet in the batch took
+    less than one wrap period (~655 ms) to arrive; other packets can then take
+    arbitrarily long.
+    """
+    send_ticks = np.asarray(send_ticks, dtype=np.int64)
+    recv_ticks = np.asarray(recv_ticks, dtype=np.int64)
+    deltas = recv_ticks - send_ticks
+    if len(deltas) == 0:
+        return deltas
+    epoch_offset = (np.min(deltas) // counter_modulus) * counter_modulus
+    return deltas - epoch_offset
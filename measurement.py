@@ -7,74 +7,234 @@ file).
 from __future__ import division
 import socket
 import time
-import argparse
+import udpsocket
+import resultsstore
+import latencysketch
+import tuning
+
+# A packet sent more than this long after its scheduled time counts as the
+# sender having missed its schedule
+SCHEDULE_MISS_TOLERANCE_SECONDS = 1e-3
 
 class Measurement:
 
-    def __init__(self, test_output_filename):
+    def __init__(self, test_output_filename, client_id=None, n_clients=None,
+                 client_timeout_seconds=15, rcvbuf_bytes=None,
+                 sndbuf_bytes=None, single_process=False,
+                 reply_to_source=False, counter_resync_seconds=0,
+                 results_db=None, run_params=None, tuning_options=None):
+        """
+        client_id identifies this host when running as a client (defaulting to
+        the hostname). n_clients and client_timeout_seconds control how long a
+        server waits for clients: it stops after n_clients clients have
+        finished (or, if n_clients is None, once no new clients have turned up
+        for client_timeout_seconds), and gives up on any individual client which
+        has been silent for client_timeout_seconds.
+
+        rcvbuf_bytes and sndbuf_bytes set the socket buffer sizes to request
+        (None meaning the system default).
+
+        single_process and reply_to_source select the round-trip client and
+        server modes in which replies go back to the address the packet came
+        from (see RoundTripMeasurement).
+
+        counter_resync_seconds is how often measurements using a hardware
+        counter actually read it (see logi_pi_timer.ExtendedCounter).
+
+        If results_db is given, results are also added to that SQLite results
+        store (see resultsstore.py), tagged with run_params (a dictionary of
+        e.g. the traffic profile and send rate).
+
+        tuning_options (a tuning.TuningOptions) control CPU pinning, scheduling
+        and busy-polling for each role's process.
+        """
         self.test_output_filename = test_output_filename
+        if client_id is None:
+            client_id = socket.gethostname()
+        self.client_id = client_id
+        self.n_clients = n_clients
+        self.client_timeout_seconds = client_timeout_seconds
+        self.rcvbuf_bytes = rcvbuf_bytes
+        self.sndbuf_bytes = sndbuf_bytes
+        self.single_process = single_process
+        self.reply_to_source = reply_to_source
+        self.counter_resync_seconds = counter_resync_seconds
+        self.results_db = results_db
+        self.run_params = run_params or {}
+        if tuning_options is None:
+            tuning_options = tuning.TuningOptions()
+        self.tuning_options = tuning_options
+        # The tuning settings this process actually got, to be saved with the
+        # results
+        self.tuning_settings = {}
+
+    def apply_tuning(self, role):
+        """
+        Apply the tuning options for role ('sender', 'receiver' or 'server')
+        to the current process, returning the settings it actually got.
+        """
+        settings = self.tuning_options.apply_to_process(role)
+        self.tuning_settings.update(settings)
+        return settings
 
-    @classmethod
-    def send_packets(cls, target_address, n_packets, packet_len, send_rate_kbytes_per_s):
+    def open_receive_socket(self, listen_port):
         """
-        Send n_packets packets, each with a payload of packet_len bytes, to
-        target_address, trying to maintain a constant send rate of
-        send_rate_kbytes_per_s.
+        Open a UDP socket listening on listen_port with the configured buffer
+        sizes, wrapped so that packets dropped because its receive buffer
+        overflowed get counted.
         """
-        send_rate_bytes_per_s = send_rate_kbytes_per_s * 1000
-        packet_rate = send_rate_bytes_per_s / packet_len
-        packet_interval = 1 / packet_rate
+        sock_in = \
+            socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        (rcvbuf_bytes, _) = udpsocket.configure_buffers(
+            sock_in, self.rcvbuf_bytes, self.sndbuf_bytes)
+        sock_in.bind(("0.0.0.0", listen_port))
+        print("Receive buffer size: %d bytes" % rcvbuf_bytes)
+        self.tuning_settings.update(
+            self.tuning_options.apply_to_socket(sock_in))
+        return udpsocket.DropCountingSocket(sock_in,
+                                            spin=self.tuning_options.spin_recv)
 
+    def open_send_socket(self, target_address):
+        """
+        Open a UDP socket connected to target_address with the configured
+        buffer sizes.
+        """
         sock_out = \
             socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        udpsocket.configure_buffers(sock_out, self.rcvbuf_bytes,
+                                    self.sndbuf_bytes)
         sock_out.connect(target_address)
+        return sock_out
 
-        cls.pre_send(n_packets, sock_out)
+    @staticmethod
+    def pad_payload(payload, packet_len):
+        """
+        Pad payload out to packet_len bytes.
+        """
+        n_fill_bytes = packet_len - len(payload)
+        fill_char = b"a"
+        return bytes(payload + n_fill_bytes * fill_char)
 
-        print("Sending %d %d-byte packets at about %d kB/s to %s:%d..." %
-              (n_packets, packet_len, send_rate_kbytes_per_s, target_address[0],
-               target_address[1]))
+    def send_packets(self, target_address, profile):
+        """
+        Send packets to target_address following the traffic profile (a
+        trafficprofile.TrafficProfile): each packet is sent at its scheduled
+        time (relative to when sending started) with its scheduled length.
 
-        send_start_seconds = time.time()
-        inter_packet_sleep_times_ms = []
-        for packet_n in range(n_packets):
-            tx_start_seconds = time.time()
+        Each packet's payload also records when it should have been sent, so
+        that latencies can be corrected for any time the sender spent behind
+        schedule (which would otherwise hide the delays a packet sent on time
+        would have seen).
 
-            payload = cls.get_packet_payload(packet_n)
-            n_fill_bytes = packet_len - len(payload)
-            fill_char = b"a"
-            payload = bytes(payload + n_fill_bytes * fill_char)
-            sock_out.sendall(payload)
+        Returns the number of packets sent behind schedule.
+        """
+        n_packets = len(profile)
+        send_offsets_seconds = profile.send_offsets_seconds
+        packet_lens = profile.packet_lens
+
+        sock_out = self.open_send_socket(target_address)
+
+        self.pre_send(n_packets, sock_out)
 
-            tx_end_seconds = time.time()
+        print("Sending %d %s to %s:%d..." %
+              (n_packets, profile.description, target_address[0],
+               target_address[1]))
 
-            # I don't know why, but this still doesn't yield exactly the desired
-            # send rate. But eh, it's good enough.
-            tx_time_seconds = tx_end_seconds - tx_start_seconds
-            sleep_time_seconds = packet_interval - tx_time_seconds
-            inter_packet_sleep_times_ms.append("%.3f" % (sleep_time_seconds * 1000))
+        n_schedule_misses = 0
+        send_start_seconds = time.time()
+        for packet_n in range(n_packets):
+            intended_send_seconds = (send_start_seconds +
+                                     send_offsets_seconds[packet_n])
+            sleep_time_seconds = intended_send_seconds - time.time()
             if sleep_time_seconds > 0:
                 time.sleep(sleep_time_seconds)
+            elif -sleep_time_seconds > SCHEDULE_MISS_TOLERANCE_SECONDS:
+                n_schedule_misses += 1
+
+            payload = self.pad_payload(
+                self.get_packet_payload(packet_n, intended_send_seconds),
+                packet_lens[packet_n])
+            sock_out.sendall(payload)
         send_end_seconds = time.time()
 
         print("Finished sending packets!")
+        print("(Fell behind schedule for %d packets)" % n_schedule_misses)
 
         total_send_duration_seconds = send_end_seconds - send_start_seconds
-        n_bytes = n_packets * packet_len
-        bytes_per_second = n_bytes / total_send_duration_seconds
-        print("(Actually sent packets at %d kB/s)" % (bytes_per_second / 1e3))
+        if total_send_duration_seconds > 0:
+            bytes_per_second = profile.total_bytes() / total_send_duration_seconds
+            print("(Actually sent packets at %d kB/s)" % (bytes_per_second / 1e3))
 
+        self.post_send(n_schedule_misses, sock_out)
         sock_out.close()
+        return n_schedule_misses
+
+    def describe_run(self, host, run_params=None):
+        """
+        Return the parameters identifying a run by host, for the results store:
+        the measurement type, the host whose packets were measured, and
+        run_params (defaulting to the parameters this test was started with).
+        """
+        description = {'measurement': type(self).__name__, 'host': host}
+        if run_params is None:
+            run_params = self.run_params
+        description.update(run_params)
+        return description
 
     @staticmethod
-    def save_packet_latencies(packetn_latency_tuples, n_packets_expected, output_filename):
+    def count_schedule_misses(packetn_latency_tuples):
+        """
+        Count the received packets which were sent late enough to count as the
+        sender missing its schedule, from the difference between each packet's
+        raw and schedule-corrected latencies. (Only for when the sender's own
+        count isn't available: this misses late packets which were then lost.)
+        """
+        tolerance_us = SCHEDULE_MISS_TOLERANCE_SECONDS * 1e6
+        return sum(1 for (_, latency_us, corrected_latency_us)
+                   in packetn_latency_tuples
+                   if corrected_latency_us - latency_us > tolerance_us)
+
+    @staticmethod
+    def save_packet_latencies(packetn_latency_tuples, n_packets_expected,
+                              output_filename, metadata=None, results_db=None,
+                              run_params=None):
         """
         Save latencies of received packets to a file, along with the total
         number of packets send in the first place.
+
+        Each tuple is (packet number, latency) or (packet number, latency,
+        latency measured from the packet's scheduled send time); the corrected
+        latency goes in an optional third column.
+
+        Any metadata (a dictionary of e.g. socket drop counters) is written
+        after the first line as '# key value' lines.
+
+        A mergeable summary of the results (see latencysketch.py) is saved
+        alongside, as output_filename + '.sketch'.
+
+        If results_db is given, the run is also appended to that results store,
+        indexed by run_params.
         """
+        packetn_latency_tuples = list(packetn_latency_tuples)
         with open(output_filename, 'w') as out_file:
             out_file.write("%d\n" % n_packets_expected)
+            if metadata:
+                for key in sorted(metadata):
+                    out_file.write("# %s %s\n" % (key, metadata[key]))
             for tup in packetn_latency_tuples:
                 packet_n = tup[0]
                 latency = "%.2f" % tup[1]
+                if len(tup) > 2:
+                    latency += " %.2f" % tup[2]
                 out_file.write("%s %s\n" % (packet_n, latency))
+
+        sketch = latencysketch.LatencySketch()
+        sketch.add_run(packetn_latency_tuples, n_packets_expected)
+        sketch.save(output_filename + latencysketch.SKETCH_FILENAME_SUFFIX)
+
+        if results_db is not None:
+            store = resultsstore.ResultsStore(results_db)
+            run_id = store.add_run(packetn_latency_tuples, n_packets_expected,
+                                   output_filename, run_params or {}, metadata)
+            store.close()
+            print("Added run %d to results store %s" % (run_id, results_db))
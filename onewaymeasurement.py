@@ -5,8 +5,56 @@ counter) accessible from both the client and the server.
 
 import measurement
 import socket
+import time
 import logi_pi_timer
 
+# Each message starts with a type field so that the server can tell control
+# messages (announcing a client and how many packets it will send) and summary
+# messages (sent once it's finished, with how many packets it sent late) from
+# data packets, regardless of payload length
+CONTROL_MESSAGE_TYPE = 'C'
+DATA_MESSAGE_TYPE = 'D'
+SUMMARY_MESSAGE_TYPE = 'S'
+
+# How often the server checks for clients which have gone quiet
+SESSION_SWEEP_INTERVAL_SECONDS = 1
+
+class ClientSession:
+    """
+    Book-keeping for packets received from one client. Everything updated per
+    packet is a simple counter so that the server's per-packet cost doesn't
+    depend on the number of clients.
+    """
+
+    def __init__(self, client_id, n_packets_expected, now,
+                 drop_statistics_at_start):
+        self.client_id = client_id
+        # None if we never received the client's control message
+        self.n_packets_expected = n_packets_expected
+        self.n_packets_received = 0
+        # Raw extended counter values, converted to latencies in one go once
+        # the session is finished
+        self.packet_ns = []
+        self.send_ticks = []
+        self.recv_ticks = []
+        self.send_lateness_us = []
+        # From the client's summary message: how many packets it sent behind
+        # schedule, including any which were then lost
+        self.n_schedule_misses = None
+        self.last_packet_time = now
+        self.drop_statistics_at_start = drop_statistics_at_start
+        # The socket's SO_RXQ_OVFL count when the session finished (the other
+        # drop counters are only read once it's been saved)
+        self.overflow_drops_at_end = None
+        self.run_params = {}
+
+    def complete(self):
+        return (self.n_packets_received == self.n_packets_expected and
+                self.n_schedule_misses is not None)
+
+    def timed_out(self, now, timeout_seconds):
+        return (now - self.last_packet_time) > timeout_seconds
+
 class OneWayMeasurement(measurement.Measurement):
 
     description = """Measure one-way UDP packet latency time.
@@ -14,115 +62,257 @@ On your server host, run:
     $ ./quack.py --server
 On your client host(s), run:
     $ ./quack.py --client <IP address of server host>
-(If starting more than one client, start them at the same time.)
+Clients can be started at any time while the server is running.
 quack.py on your server host will spit out one file for each client containing
 the latencies of each packet received from the corresponding client.
 """
 
-    @classmethod
-    def run_client(cls, target_address, n_packets, payload_len,
-            send_rate_kbytes_per_s):
-        cls.send_packets(target_address, n_packets, payload_len, send_rate_kbytes_per_s)
+    def run_client(self, target_address, profile):
+        # The server saves the results, so send it the tuning settings we got
+        # along with the other run parameters
+        self.run_params.update(self.apply_tuning('sender'))
+        self.send_packets(target_address, profile)
 
-    @classmethod
-    def pre_send(cls, n_packets, sock_out):
+    def pre_send(self, n_packets, sock_out):
         """
-        Let the server know how many packets to expect
+        Let the server know how many packets to expect (and the parameters of
+        this run, as key=value fields, for the server's results store)
         """
-        host_id = cls.guess_host_id()
-        sock_out.sendall(("%d %d" % (host_id, n_packets)).encode())
+        self.check_client_id()
+        self.counter = logi_pi_timer.ExtendedCounter(self.counter_resync_seconds)
+        message = "%s %s %d" % (CONTROL_MESSAGE_TYPE, self.client_id, n_packets)
+        for key in sorted(self.run_params):
+            value = str(self.run_params[key])
+            if len(value.split()) == 1:
+                message += " %s=%s" % (key, value)
+        sock_out.sendall(message.encode())
 
-    @classmethod
-    def get_packet_payload(cls, packet_n):
+    def post_send(self, n_schedule_misses, sock_out):
+        """
+        Let the server know how many packets we sent behind schedule (which it
+        can't tell for packets which were lost)
+        """
+        message = "%s %s %d" % (SUMMARY_MESSAGE_TYPE, self.client_id,
+                                n_schedule_misses)
+        sock_out.sendall(message.encode())
+
+    def get_packet_payload(self, packet_n, intended_send_seconds):
         """
         Return a packet payload consisting of:
-        - The packet number
-        - The current counter value
-        - A host 'ID' representing this client specifically
+        - The message type
+        - The ID of this client
           (so that received packets can later be separated)
+        - The packet number
+        - The current (extended) counter value
+        - How late (in microseconds, by the host clock) the packet is being
+          sent compared to when it was scheduled to be sent
         """
-        host_id = cls.guess_host_id()
-        counter_value_send = logi_pi_timer.read_counter()
-        payload = "%05d %05d %d" % (packet_n, counter_value_send, host_id)
-        return payload
+        counter_value_send = self.counter.read()
+        send_lateness_us = (time.time() - intended_send_seconds) * 1e6
+        payload = "%s %s %d %d %d" % (DATA_MESSAGE_TYPE, self.client_id,
+                                      packet_n, counter_value_send,
+                                      send_lateness_us)
+        return payload.encode()
 
-    @staticmethod
-    def guess_host_id():
+    def check_client_id(self):
         """
-        Try and come up with a suitable host ID by looking at the hostname.
-        e.g. hostname raspberrypi2 => host ID = '2'
+        Make sure that the client ID can be unambiguously parsed by the server.
         """
-        hostname = socket.gethostname()
-        host_id = int(hostname[-1])
-        return host_id
+        if len(self.client_id.split()) != 1:
+            raise ValueError("Client ID '%s' must be non-empty and must not "
+                             "contain whitespace" % self.client_id)
 
     def run_server(self, server_listen_port, recv_buffer_size):
         """
-        Receive packets sent from the client. Calculate the latency for each
+        Receive packets sent from the clients. Calculate the latency for each
         packet by comparing the counter value from the packet (the counter value
         at time of transmission) to the current counter value.
+
+        Clients may join at any point. Each client is finished once all its
+        packets have arrived or it has been silent for client_timeout_seconds,
+        and its latencies are saved as soon as the socket goes idle (or the
+        server exits), so that saving doesn't delay other clients' packets.
         """
-        sock_in = \
-            socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock_in.bind(("0.0.0.0", server_listen_port))
+        self.apply_tuning('server')
+        sock_in = self.open_receive_socket(server_listen_port)
+        # Wake up regularly even if nothing arrives, so that we notice clients
+        # which have gone quiet
+        sock_in.settimeout(SESSION_SWEEP_INTERVAL_SECONDS)
 
-        print("UDP server running...")
+        counter = logi_pi_timer.ExtendedCounter(self.counter_resync_seconds)
 
-        all_hosts_expected_n_packets = {}
-        packet_n_latency_tuples = {}
+        print("UDP server running...")
 
-        first_packet = True
+        active_sessions = {}
+        # Finished, but waiting for the socket to go idle to be saved
+        pending_sessions = []
+        finished_client_ids = set()
+        n_finished_sessions = 0
+        last_new_session_time = None
+        last_sweep_time = time.time()
+        # Reading /proc/net/udp is too slow to do while packets are arriving,
+        # so drop counters are only read when the socket is idle (when they
+        # can't be changing)
+        idle_drop_statistics = sock_in.drop_statistics()
 
         try:
-            while not self.all_clients_all_packets_received(packet_n_latency_tuples, all_hosts_expected_n_packets):
-                data = sock_in.recv(recv_buffer_size)
-                if not data:
-                    break
-                data = data.decode()
-
-                if first_packet:
-                    timeout_seconds = 15
-                    sock_in.settimeout(timeout_seconds)
-                first_packet = False
-
-                if len(data) < 128:
-                    (host_id, expected_n_packets) = [int(x) for x in data.split(' ')]
-                    print("Expecting %d packets from host %d" % (expected_n_packets, host_id))
-                    packet_n_latency_tuples[host_id] = []
-                    all_hosts_expected_n_packets[host_id] = expected_n_packets
-                else:
-                    counter_value_recv = logi_pi_timer.read_counter()
-                    payload = data.rstrip('a')
-                    (packet_n, counter_value_send, host_id) = \
-                        [int(x) for x in payload.split(' ')]
+            while True:
+                try:
+                    data = sock_in.recv(recv_buffer_size)
+                except socket.timeout:
+                    data = None
+                    if pending_sessions:
+                        idle_drop_statistics = self.finish_pending_sessions(
+                            pending_sessions, sock_in)
 
-                    delta = logi_pi_timer.counter_delta(counter_value_recv, counter_value_send)
-                    latency_us = logi_pi_timer.counter_delta_to_us(delta)
-                    packet_n_latency_tuples[host_id].append((packet_n, latency_us))
-        except socket.timeout:
-            print("Note: timed out waiting to receive packets")
+                if data:
+                    counter_value_recv = counter.read()
+                    now = time.time()
+                    fields = data.rstrip(b'a').decode().split(' ')
+                    message_type = fields[0]
+                    if message_type not in (CONTROL_MESSAGE_TYPE,
+                                            DATA_MESSAGE_TYPE,
+                                            SUMMARY_MESSAGE_TYPE):
+                        print("Warning: ignoring message of unknown type '%s'" %
+                              message_type)
+                        continue
+                    client_id = fields[1]
 
-        sock_in.close()
+                    session = active_sessions.get(client_id)
+                    if session is None:
+                        if (client_id in finished_client_ids and
+                                message_type != CONTROL_MESSAGE_TYPE):
+                            # A straggler from a client we've already given up on
+                            continue
+                        finished_client_ids.discard(client_id)
+                        drop_statistics_at_start = dict(idle_drop_statistics)
+                        if sock_in.n_overflow_drops is not None:
+                            drop_statistics_at_start['rxq_overflow_drops'] = \
+                                sock_in.n_overflow_drops
+                        session = ClientSession(client_id, None, now,
+                                                drop_statistics_at_start)
+                        active_sessions[client_id] = session
+                        last_new_session_time = now
+                    session.last_packet_time = now
 
-        for host_id in packet_n_latency_tuples.keys():
-            print("Received %d packets from host %d" % (len(packet_n_latency_tuples[host_id]), host_id))
+                    if message_type == CONTROL_MESSAGE_TYPE:
+                        session.n_packets_expected = int(fields[2])
+                        session.run_params = dict(
+                            field.split('=', 1) for field in fields[3:])
+                        print("Expecting %d packets from client %s" %
+                              (session.n_packets_expected, client_id))
+                    elif message_type == SUMMARY_MESSAGE_TYPE:
+                        session.n_schedule_misses = int(fields[2])
+                    else:
+                        session.packet_ns.append(int(fields[2]))
+                        session.send_ticks.append(int(fields[3]))
+                        session.send_lateness_us.append(int(fields[4]))
+                        session.recv_ticks.append(counter_value_recv)
+                        session.n_packets_received += 1
+
+                    if session.complete():
+                        del active_sessions[client_id]
+                        finished_client_ids.add(client_id)
+                        session.overflow_drops_at_end = sock_in.n_overflow_drops
+                        pending_sessions.append(session)
+                        n_finished_sessions += 1
+                else:
+                    now = time.time()
+
+                if now - last_sweep_time >= SESSION_SWEEP_INTERVAL_SECONDS:
+                    last_sweep_time = now
+                    for session in list(active_sessions.values()):
+                        if session.timed_out(now, self.client_timeout_seconds):
+                            print("Note: timed out waiting to receive packets "
+                                  "from client %s" % session.client_id)
+                            del active_sessions[session.client_id]
+                            finished_client_ids.add(session.client_id)
+                            session.overflow_drops_at_end = \
+                                sock_in.n_overflow_drops
+                            pending_sessions.append(session)
+                            n_finished_sessions += 1
+
+                if active_sessions or n_finished_sessions == 0:
+                    continue
+                if self.n_clients is not None:
+                    if n_finished_sessions >= self.n_clients:
+                        break
+                elif (now - last_new_session_time) > self.client_timeout_seconds:
+                    break
+        except KeyboardInterrupt:
+            pending_sessions.extend(active_sessions.values())
 
-        for host_id in packet_n_latency_tuples.keys():
-            host_filename = self.test_output_filename + '_' + str(host_id)
-            self.save_packet_latencies(packet_n_latency_tuples[host_id], all_hosts_expected_n_packets[host_id], host_filename)
+        self.finish_pending_sessions(pending_sessions, sock_in)
+        sock_in.close()
 
+    def finish_pending_sessions(self, pending_sessions, sock_in):
+        """
+        Save and forget all the sessions in pending_sessions. Returns the
+        socket's drop statistics as read beforehand.
+        """
+        drop_statistics = sock_in.drop_statistics()
+        for session in pending_sessions:
+            drop_statistics_at_end = dict(drop_statistics)
+            if session.overflow_drops_at_end is not None:
+                drop_statistics_at_end['rxq_overflow_drops'] = \
+                    session.overflow_drops_at_end
+            self.finish_session(session, drop_statistics_at_end)
+        del pending_sessions[:]
+        return drop_statistics
 
-    @staticmethod
-    def all_clients_all_packets_received(packets, expected_n_packets):
+    def finish_session(self, session, drop_statistics_at_end):
         """
-        Decide whether or not we've received all the packets we're expecting
-        from all of the hosts that are sending packets.
+        Calculate and save the latencies of all packets received from one
+        client, along with the number of packets our receive socket dropped
+        while the client was sending.
         """
-        if len(packets) == 0:
-            return False
-
-        all_received = True
-        for host_id in packets:
-            if len(packets[host_id]) != expected_n_packets[host_id]:
-                all_received = False
-        return all_received
+        print("Received %d packets from client %s" %
+              (session.n_packets_received, session.client_id))
+
+        n_packets_expected = session.n_packets_expected
+        if n_packets_expected is None and not session.packet_ns:
+            # e.g. all we got was the client's summary message
+            print("Warning: nothing to save for client %s" % session.client_id)
+            return
+        if n_packets_expected is None:
+            # The control message got lost, so the best we can do is guess
+            # from the packet numbers we did see
+            n_packets_expected = 1 + max(session.packet_ns)
+            print("Warning: never heard how many packets client %s was sending; "
+                  "assuming %d" % (session.client_id, n_packets_expected))
+
+        # The socket's drop counters are cumulative and shared between all
+        # clients, so we can only attribute drops to this client's session as a
+        # whole (which is exact if it was the only client sending at the time).
+        # /proc/net/udp is read when the session is saved rather than when it
+        # finished, so may also include drops from other clients since then.
+        metadata = dict(drop_statistics_at_end)
+        for key in ['rxq_overflow_drops', 'proc_net_udp_drops']:
+            if key in metadata and key in session.drop_statistics_at_start:
+                metadata[key] -= session.drop_statistics_at_start[key]
+
+        deltas = logi_pi_timer.unwrap_counter_deltas(session.send_ticks,
+                                                     session.recv_ticks)
+        latencies_us = logi_pi_timer.counter_delta_to_us(deltas)
+        corrected_latencies_us = latencies_us + session.send_lateness_us
+        packet_n_latency_tuples = list(zip(session.packet_ns,
+                                           latencies_us.tolist(),
+                                           corrected_latencies_us.tolist()))
+        if session.n_schedule_misses is not None:
+            metadata['n_schedule_misses'] = session.n_schedule_misses
+        else:
+            # The summary message got lost, so we can only count the late
+            # packets which made it
+            metadata['n_received_schedule_misses'] = \
+                self.count_schedule_misses(packet_n_latency_tuples)
+        metadata.update(self.tuning_settings)
+        metadata.update((key, value) for (key, value)
+                        in session.run_params.items()
+                        if key.startswith('sender_'))
+
+        host_filename = self.test_output_filename + '_' + session.client_id
+        self.save_packet_latencies(packet_n_latency_tuples,
+                                   n_packets_expected, host_filename,
+                                   metadata, self.results_db,
+                                   self.describe_run(session.client_id,
+                                                     session.run_params))
@@ -7,8 +7,8 @@ server can read from.
 
 One or more hosts run the script in client mode.
 Client mode simply sends packets to the designated target address.
-(If you want to have more than one client, they must all be started at the
-same time.)
+(Clients can be started at any time while the server is running; each one
+identifies itself to the server with --client_id, or its hostname by default.)
 
 The other host runs the script in server mode.
 Server mode receives packets from all the transmitting clients and saves them
@@ -0,0 +1,128 @@
+"""
+A SQLite database of measurement runs, so that results from many runs can be
+queried together (see analysis/query_results.py) without opening every
+latencies file.
+
+Each run gets one row in the 'runs' table, recording the parameters it was run
+with and summary statistics (loss and latency percentiles) calculated when it
+was saved. The latency of every received packet goes in the 'packets' table.
+"""
+
+from __future__ import division
+import json
+import sqlite3
+import time
+
+# Latency percentiles summarised for each run, and the columns they go in
+SUMMARY_PERCENTILES = [(50, 'latency_p50_us'), (90, 'latency_p90_us'),
+                       (99, 'latency_p99_us'), (99.9, 'latency_p99_9_us')]
+
+# Run parameters which get their own (indexed) column; anything else is kept
+# in the 'params' column as JSON
+RUN_PARAM_COLUMNS = ['measurement', 'host', 'target', 'traffic_profile',
+                     'payload_len', 'send_rate_kBps']
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    saved_at REAL NOT NULL,
+    output_filename TEXT,
+    measurement TEXT,
+    host TEXT,
+    target TEXT,
+    traffic_profile TEXT,
+    payload_len INTEGER,
+    send_rate_kBps REAL,
+    n_packets_expected INTEGER NOT NULL,
+    n_packets_received INTEGER NOT NULL,
+    loss_pct REAL,
+    latency_p50_us REAL,
+    latency_p90_us REAL,
+    latency_p99_us REAL,
+    latency_p99_9_us REAL,
+    latency_max_us REAL,
+    params TEXT,
+    metadata TEXT
+);
+CREATE INDEX IF NOT EXISTS runs_by_params
+    ON runs (measurement, traffic_profile, payload_len, send_rate_kBps, saved_at);
+CREATE INDEX IF NOT EXISTS runs_by_host ON runs (host, saved_at);
+CREATE INDEX IF NOT EXISTS runs_by_time ON runs (saved_at);
+CREATE TABLE IF NOT EXISTS packets (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    packet_n INTEGER NOT NULL,
+    latency_us REAL NOT NULL,
+    corrected_latency_us REAL
+);
+CREATE INDEX IF NOT EXISTS packets_by_run ON packets (run_id);
+"""
+
+def percentile(sorted_values, pct):
+    """
+    Calculate the pct'th percentile of an already-sorted list of values,
+    interpolating linearly between the closest ranks (as numpy.percentile does
+    by default).
+    """
+    if len(sorted_values) == 0:
+        return None
+    rank = (len(sorted_values) - 1) * pct / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    fraction = rank - lower
+    return (sorted_values[lower] +
+            (sorted_values[upper] - sorted_values[lower]) * fraction)
+
+class ResultsStore:
+
+    def __init__(self, db_filename):
+        self.connection = sqlite3.connect(db_filename)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def add_run(self, packetn_latency_tuples, n_packets_expected,
+                output_filename, run_params, metadata=None):
+        """
+        Add one run to the store: its parameters (a dictionary, e.g. host,
+        payload_len, send_rate_kBps), summary statistics, any metadata (e.g.
+        socket drop counters), and the latency (and, if known, the latency
+        corrected to the packet's scheduled send time) of every packet
+        received.
+        Returns the new run's ID.
+        """
+        packetn_latency_tuples = list(packetn_latency_tuples)
+        sorted_latencies = sorted(tup[1] for tup in packetn_latency_tuples)
+        n_packets_received = len(packetn_latency_tuples)
+
+        row = {
+            'saved_at': time.time(),
+            'output_filename': output_filename,
+            'n_packets_expected': n_packets_expected,
+            'n_packets_received': n_packets_received,
+            'latency_max_us': sorted_latencies[-1] if sorted_latencies else None,
+            'params': json.dumps(dict((k, v) for (k, v) in run_params.items()
+                                      if k not in RUN_PARAM_COLUMNS)),
+            'metadata': json.dumps(metadata or {}),
+        }
+        if n_packets_expected > 0:
+            row['loss_pct'] = 100 * (1 - n_packets_received / n_packets_expected)
+        for (pct, column) in SUMMARY_PERCENTILES:
+            row[column] = percentile(sorted_latencies, pct)
+        for column in RUN_PARAM_COLUMNS:
+            row[column] = run_params.get(column)
+
+        columns = sorted(row)
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (%s) VALUES (%s)" % (
+                    ', '.join(columns), ', '.join(['?'] * len(columns))),
+                [row[column] for column in columns])
+            run_id = cursor.lastrowid
+            self.connection.executemany(
+                "INSERT INTO packets "
+                "(run_id, packet_n, latency_us, corrected_latency_us) "
+                "VALUES (?, ?, ?, ?)",
+                ((run_id, tup[0], tup[1], tup[2] if len(tup) > 2 else None)
+                 for tup in packetn_latency_tuples))
+        return run_id
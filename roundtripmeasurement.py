@@ -3,11 +3,36 @@ Measure round-trip packet latencies.
 """
 
 import measurement
+import heapq
 import socket
+import selectors
 import multiprocessing
 import time
 import pickle
+import queue
 import sys
+import udpsocket
+
+# How long to wait for replies after the last packet has been sent
+RECV_TIMEOUT_SECONDS = 5
+# Packets can end up longer than the profile asked for if the timestamp payload
+# doesn't fit, so always leave at least this much room when receiving
+MIN_RECV_BUFFER_SIZE = 4096
+
+class MeshTarget:
+    """
+    Book-keeping for one of the servers being probed by run_client_mesh.
+    """
+
+    def __init__(self, address, start_seconds):
+        self.address = address
+        # When this target's copy of the send schedule started
+        self.start_seconds = start_seconds
+        self.sock = None
+        self.sock_in = None
+        self.n_packets_sent = 0
+        self.n_schedule_misses = 0
+        self.packets = []
 
 class RoundTripMeasurement(measurement.Measurement):
 
@@ -17,22 +42,32 @@ On your server host, run:
 On your client host(s), run:
     $ ./echo.py --client <IP address of server host>
 echo.py on your client host will spit out a file containing the round-trip
-latencies of each packet received back from the server."""
+latencies of each packet received back from the server.
+(If there's a NAT between the hosts, run the server with --reply_to_source and
+the client with --single_process.)"""
 
-    def run_client(self, target_address, n_packets, payload_len,
-            send_rate_kbytes_per_s):
+    def run_client(self, target_address, profile):
         """
         Start the two client threads: one to send packets, and one to receive them.
+        (Or, in single-process mode, do both from one event loop.)
         """
+        if self.single_process:
+            self.run_client_single_process(target_address, profile)
+            return
+
+        # The receiver saves the results, so the sender passes back the tuning
+        # settings it got to be saved with them
+        sender_settings_queue = multiprocessing.Queue()
         sender = multiprocessing.Process(
-            target=self.send_packets,
-            args=(target_address, n_packets, payload_len, send_rate_kbytes_per_s))
+            target=self.run_sender,
+            args=(target_address, profile, sender_settings_queue))
 
         listen_port = target_address[1] + 1
         output_filename = self.test_output_filename
         receiver = multiprocessing.Process(
             target=self.recv_packets,
-            args=(listen_port, n_packets, payload_len, output_filename))
+            args=(listen_port, len(profile), self.recv_buffer_size(profile),
+                  output_filename, sender_settings_queue))
 
         receiver.start()
         sender.start()
@@ -40,20 +75,179 @@ latencies of each packet received back from the server."""
         sender.join()
         receiver.join()
 
+    def run_sender(self, target_address, profile, sender_settings_queue):
+        """
+        Apply the sender's tuning options, send packets, then report the
+        settings it got and how many packets it sent behind schedule via
+        sender_settings_queue.
+        """
+        sender_settings = self.apply_tuning('sender')
+        sender_settings['n_schedule_misses'] = \
+            self.send_packets(target_address, profile)
+        sender_settings_queue.put(sender_settings)
+
+    def run_client_single_process(self, target_address, profile):
+        """
+        Send packets to the server and receive the replies on the same connected
+        socket, from a single event loop which sleeps until either the next
+        packet is due to be sent or a reply arrives. This avoids spawning any
+        processes and means that replies can come back through a NAT, but
+        requires a server which replies to the source address of each packet
+        (i.e. one run with --reply_to_source).
+        """
+        self.run_client_mesh([target_address], profile)
+
+    def run_client_mesh(self, target_addresses, profile):
+        """
+        Probe several servers (all run with --reply_to_source) concurrently
+        from one event loop, as in single-process mode. Each target gets its own
+        socket, its own copy of the send schedule and its own packet numbers,
+        and its latencies are saved to <output filename>_<host>_<port> (or, if
+        there's only one target, just to the output filename).
+        """
+        n_packets = len(profile)
+        recv_buffer_size = self.recv_buffer_size(profile)
+
+        self.apply_tuning('sender')
+        # With spin_recv, poll the sockets rather than sleeping in select
+        spin = self.tuning_options.spin_recv
+        selector = selectors.DefaultSelector()
+
+        # Stagger the targets' schedules across the mean gap between packets,
+        # so that we don't send a burst of packets (one per target) each time
+        if n_packets > 1:
+            mean_gap_seconds = \
+                profile.send_offsets_seconds[-1] / (n_packets - 1)
+        else:
+            mean_gap_seconds = 0
+        send_start_seconds = time.time()
+        targets = []
+        send_queue = []
+        for (i, target_address) in enumerate(target_addresses):
+            target = MeshTarget(target_address, send_start_seconds +
+                                i * mean_gap_seconds / len(target_addresses))
+            target.sock = self.open_send_socket(target_address)
+            target.sock.setblocking(False)
+            self.tuning_settings.update(
+                self.tuning_options.apply_to_socket(target.sock))
+            target.sock_in = udpsocket.DropCountingSocket(target.sock)
+            selector.register(target.sock, selectors.EVENT_READ, target)
+            targets.append(target)
+            heapq.heappush(send_queue, (target.start_seconds, i))
+
+        print("Sending %d %s to %s..." %
+              (n_packets, profile.description,
+               ', '.join("%s:%d" % tuple(target.address)
+                         for target in targets)))
+
+        n_targets_incomplete = len(targets)
+        while n_targets_incomplete > 0:
+            now = time.time()
+            if send_queue:
+                (next_send_seconds, i) = send_queue[0]
+                if now >= next_send_seconds:
+                    target = targets[i]
+                    packet_n = target.n_packets_sent
+                    if (now - next_send_seconds >
+                            measurement.SCHEDULE_MISS_TOLERANCE_SECONDS):
+                        target.n_schedule_misses += 1
+                    payload = self.pad_payload(
+                        self.get_packet_payload(packet_n, next_send_seconds),
+                        profile.packet_lens[packet_n])
+                    try:
+                        target.sock.send(payload)
+                    except ConnectionRefusedError:
+                        # ICMP port unreachable from an earlier packet; keep
+                        # to the schedule regardless
+                        pass
+                    target.n_packets_sent += 1
+                    if target.n_packets_sent < n_packets:
+                        heapq.heapreplace(
+                            send_queue,
+                            (target.start_seconds +
+                             profile.send_offsets_seconds[target.n_packets_sent],
+                             i))
+                    else:
+                        heapq.heappop(send_queue)
+                        if not send_queue:
+                            print("Finished sending packets!")
+                            print("(Fell behind schedule for %d packets)" %
+                                  sum(target.n_schedule_misses
+                                      for target in targets))
+                            recv_deadline_seconds = \
+                                time.time() + RECV_TIMEOUT_SECONDS
+                    continue
+                timeout_seconds = next_send_seconds - now
+            else:
+                timeout_seconds = recv_deadline_seconds - now
+                if timeout_seconds <= 0:
+                    print("Note: timed out waiting to receive packets")
+                    break
+
+            for (key, _) in selector.select(0 if spin else timeout_seconds):
+                target = key.data
+                was_complete = len(target.packets) >= n_packets
+                self.recv_available_packets(target.sock_in, recv_buffer_size,
+                                            target.packets)
+                if not was_complete and len(target.packets) >= n_packets:
+                    n_targets_incomplete -= 1
+
+        for target in targets:
+            target_name = "%s:%d" % tuple(target.address)
+            print("Received %d/%d packets back from %s" %
+                  (len(target.packets), n_packets, target_name))
+            if len(targets) == 1:
+                output_filename = self.test_output_filename
+            else:
+                output_filename = "%s_%s_%d" % ((self.test_output_filename, ) +
+                                                tuple(target.address))
+            metadata = target.sock_in.drop_statistics()
+            metadata['n_schedule_misses'] = target.n_schedule_misses
+            metadata.update(self.tuning_settings)
+            run_params = dict(self.run_params, target=target_name)
+            self.save_packet_latencies(target.packets, n_packets,
+                                       output_filename, metadata,
+                                       self.results_db,
+                                       self.describe_run(self.client_id,
+                                                         run_params))
+            selector.unregister(target.sock)
+            target.sock.close()
+        selector.close()
+
+    def recv_available_packets(self, sock_in, recv_buffer_size, packets):
+        """
+        Receive all packets waiting on the (non-blocking) socket sock_in,
+        appending a (packet number, latency) tuple for each to packets.
+        """
+        while True:
+            try:
+                packet = sock_in.recv(recv_buffer_size)
+            except BlockingIOError:
+                return
+            except ConnectionRefusedError:
+                # ICMP port unreachable from an earlier packet; the server may
+                # just not have been up yet
+                continue
+            recv_time = time.time()
+            packets.append(self.parse_packet(packet, recv_time))
 
     @staticmethod
     def pre_send(n_packets, sock_out):
         return
 
+    @staticmethod
+    def post_send(n_schedule_misses, sock_out):
+        return
+
     def run_server(self, listen_port, recv_buffer_size):
         """
         Listen for UDP packets on listen_port, and when a packet is
         received, immediately send it back to the host it came from (to
-        port listen_port + 1).
+        port listen_port + 1, or with reply_to_source, to the port it came
+        from).
         """
-        sock_in = \
-            socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock_in.bind(("0.0.0.0", listen_port))
+        self.apply_tuning('server')
+        sock_in = self.open_receive_socket(listen_port)
 
         sock_out = \
             socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
@@ -65,45 +259,61 @@ latencies of each packet received back from the server."""
                 data, recv_addr = sock_in.recvfrom(recv_buffer_size)
                 if not data:
                     break
-                send_addr = (recv_addr[0], listen_port + 1)
-                sock_out.sendto(data, send_addr)
+                if self.reply_to_source:
+                    sock_in.sendto(data, recv_addr)
+                else:
+                    send_addr = (recv_addr[0], listen_port + 1)
+                    sock_out.sendto(data, send_addr)
             except KeyboardInterrupt:
                 break
         print("Closing...")
+        print("Receive socket drop statistics: %s" % sock_in.drop_statistics())
         sock_out.close()
         sys.exit(0)
 
     @classmethod
-    def get_packet_payload(cls, packet_n):
+    def get_packet_payload(cls, packet_n, intended_send_seconds):
         send_time_seconds = time.time()
-        payload = pickle.dumps((packet_n, send_time_seconds))
+        payload = pickle.dumps((packet_n, send_time_seconds,
+                                intended_send_seconds))
         return payload
 
-    @classmethod
-    def recv_packets(cls, listen_port, n_packets_expected, payload_len,
-                     output_filename):
+    @staticmethod
+    def parse_packet(packet, recv_time):
+        """
+        Return the packet number and round-trip latency (in microseconds) of a
+        packet bounced back from the server, both as measured from when the
+        packet was actually sent and from when it should have been sent.
+        """
+        payload = packet.rstrip(b"a")
+        (packet_n, send_time, intended_send_time) = pickle.loads(payload)
+        latency_us = (recv_time - send_time) * 1e6
+        corrected_latency_us = (recv_time - intended_send_time) * 1e6
+        return (packet_n, latency_us, corrected_latency_us)
+
+    @staticmethod
+    def recv_buffer_size(profile):
+        return max(profile.max_packet_len(), MIN_RECV_BUFFER_SIZE)
+
+    def recv_packets(self, listen_port, n_packets_expected, recv_buffer_size,
+                     output_filename, sender_settings_queue=None):
         """
         Receive packets bounced back from the server. Calculate the round-trip
         latency for each packet by comparing the transmission timestamp contained
         within the packet to the system time at time of packet receipt.
         """
 
-        sock_in = \
-            socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
-        sock_in.bind(("0.0.0.0", listen_port))
+        self.apply_tuning('receiver')
+        sock_in = self.open_receive_socket(listen_port)
 
-        timeout_seconds = 5
-        sock_in.settimeout(timeout_seconds)
+        sock_in.settimeout(RECV_TIMEOUT_SECONDS)
 
         packets = []
         try:
             while len(packets) < n_packets_expected:
-                packet = sock_in.recv(payload_len)
+                packet = sock_in.recv(recv_buffer_size)
                 recv_time = time.time()
-                payload = packet.rstrip(b"a")
-                (packet_n, send_time) = pickle.loads(payload)
-                latency_us = (recv_time - send_time) * 1e6
-                packets.append((packet_n, latency_us))
+                packets.append(self.parse_packet(packet, recv_time))
         except socket.timeout:
             print("Note: timed out waiting to receive packets")
             print("So far, had received %d packets" % len(packets))
@@ -111,5 +321,23 @@ latencies of each packet received back from the server."""
         print("Received %d/%d packets back from server" % (len(packets),
                                                            n_packets_expected))
 
-        cls.save_packet_latencies(packets, n_packets_expected, output_filename)
+        metadata = sock_in.drop_statistics()
+        metadata.update(self.tuning_settings)
+        sender_settings = None
+        if sender_settings_queue is not None:
+            try:
+                sender_settings = sender_settings_queue.get(
+                    timeout=RECV_TIMEOUT_SECONDS)
+            except queue.Empty:
+                print("Warning: never heard back from the sending process")
+        if sender_settings is not None:
+            metadata.update(sender_settings)
+        else:
+            # The best we can do is count how many of the packets we received
+            # were sent behind schedule
+            metadata['n_received_schedule_misses'] = \
+                self.count_schedule_misses(packets)
+        self.save_packet_latencies(packets, n_packets_expected, output_filename,
+                                   metadata, self.results_db,
+                                   self.describe_run(self.client_id))
         sock_in.close()
@@ -0,0 +1,136 @@
+"""
+Traffic profiles describing when each packet should be sent and how big it
+should be.
+
+Each profile is precomputed into arrays of send times (relative to the start of
+sending) and packet lengths before any packets are sent, so that the send loop
+only has to look values up.
+"""
+
+from __future__ import division
+import array
+import random
+
+# Typical durations of talk-spurts and the silences between them in
+# conversational speech
+DEFAULT_MEAN_ON_MS = 1000
+DEFAULT_MEAN_OFF_MS = 1350
+
+class TrafficProfile:
+
+    def __init__(self, send_offsets_seconds, packet_lens, description):
+        """
+        send_offsets_seconds: time at which to send each packet, relative to
+                              the start of sending
+        packet_lens:          length of each packet, in bytes
+        description:          human-readable summary of the profile
+        """
+        self.send_offsets_seconds = array.array('d', send_offsets_seconds)
+        self.packet_lens = array.array('I', packet_lens)
+        self.description = description
+
+    def __len__(self):
+        return len(self.packet_lens)
+
+    def max_packet_len(self):
+        return max(self.packet_lens) if len(self) > 0 else 0
+
+    def total_bytes(self):
+        return sum(self.packet_lens)
+
+def constant_rate(n_packets, packet_len, send_rate_kbytes_per_s):
+    """
+    Send n_packets packet_len-byte packets at a constant rate.
+    """
+    packet_interval = packet_len / (send_rate_kbytes_per_s * 1000)
+    send_offsets_seconds = [packet_n * packet_interval
+                            for packet_n in range(n_packets)]
+    description = "%d-byte packets at about %d kB/s" % (
+        packet_len, send_rate_kbytes_per_s)
+    return TrafficProfile(send_offsets_seconds, [packet_len] * n_packets,
+                          description)
+
+def poisson(n_packets, packet_len, send_rate_kbytes_per_s, rng):
+    """
+    Send n_packets packet_len-byte packets with exponentially-distributed gaps
+    between them, averaging send_rate_kbytes_per_s.
+    """
+    packet_rate = send_rate_kbytes_per_s * 1000 / packet_len
+    send_offsets_seconds = []
+    send_offset_seconds = 0
+    for _ in range(n_packets):
+        send_offsets_seconds.append(send_offset_seconds)
+        send_offset_seconds += rng.expovariate(packet_rate)
+    description = "%d-byte packets at an average of %d kB/s (Poisson)" % (
+        packet_len, send_rate_kbytes_per_s)
+    return TrafficProfile(send_offsets_seconds, [packet_len] * n_packets,
+                          description)
+
+def on_off(n_packets, packet_len, send_rate_kbytes_per_s, mean_on_ms,
+           mean_off_ms, rng):
+    """
+    Alternate between 'on' periods, during which packet_len-byte packets are
+    sent at a constant send_rate_kbytes_per_s (like the frames of a talk-spurt
+    of audio), and 'off' periods during which nothing is sent. The durations of
+    both are exponentially distributed with the given means.
+    """
+    packet_interval = packet_len / (send_rate_kbytes_per_s * 1000)
+    send_offsets_seconds = []
+    period_start_seconds = 0
+    while len(send_offsets_seconds) < n_packets:
+        on_seconds = rng.expovariate(1000 / mean_on_ms)
+        send_offset_seconds = period_start_seconds
+        while (send_offset_seconds < period_start_seconds + on_seconds and
+               len(send_offsets_seconds) < n_packets):
+            send_offsets_seconds.append(send_offset_seconds)
+            send_offset_seconds += packet_interval
+        period_start_seconds += on_seconds + rng.expovariate(1000 / mean_off_ms)
+    description = ("%d-byte packets at about %d kB/s in bursts "
+                   "(mean %d ms on, %d ms off)" % (
+                       packet_len, send_rate_kbytes_per_s, mean_on_ms,
+                       mean_off_ms))
+    return TrafficProfile(send_offsets_seconds, [packet_len] * n_packets,
+                          description)
+
+def from_trace_file(trace_filename):
+    """
+    Replay a recorded trace. The trace file contains one packet per line: the
+    time at which the packet was sent (in seconds) and its length (in bytes),
+    separated by whitespace. Lines starting with '#' are ignored.
+    """
+    send_offsets_seconds = []
+    packet_lens = []
+    with open(trace_filename, 'r') as trace_file:
+        for line in trace_file:
+            if len(line.strip()) == 0 or line.startswith('#'):
+                continue
+            fields = line.split()
+            send_offsets_seconds.append(float(fields[0]))
+            packet_lens.append(int(fields[1]))
+    if send_offsets_seconds:
+        first_send_seconds = send_offsets_seconds[0]
+        send_offsets_seconds = [t - first_send_seconds
+                                for t in send_offsets_seconds]
+    description = "packets replayed from trace '%s'" % trace_filename
+    return TrafficProfile(send_offsets_seconds, packet_lens, description)
+
+def from_args(args):
+    """
+    Build the traffic profile specified by command-line arguments.
+    """
+    rng = random.Random(args.seed)
+    if args.traffic_profile == 'cbr':
+        return constant_rate(args.n_packets, args.payload_len,
+                             args.send_rate_kBps)
+    elif args.traffic_profile == 'poisson':
+        return poisson(args.n_packets, args.payload_len, args.send_rate_kBps,
+                       rng)
+    elif args.traffic_profile == 'on_off':
+        return on_off(args.n_packets, args.payload_len, args.send_rate_kBps,
+                      args.mean_on_ms, args.mean_off_ms, rng)
+    elif args.traffic_profile == 'trace':
+        if args.trace_filename is None:
+            raise ValueError("--traffic_profile trace requires --trace_filename")
+        return from_trace_file(args.trace_filename)
+    else:
+        raise ValueError("Unknown traffic profile '%s'" % args.traffic_profile)
@@ -0,0 +1,107 @@
+"""
+Options for reducing jitter introduced by the measurement processes
+themselves: pinning each process to a CPU, real-time (SCHED_FIFO) scheduling,
+locking memory, and busy-polling receive sockets.
+
+These mostly need Linux and root (or the right capabilities). Anything that
+can't be applied is reported with a warning rather than stopping the test, and
+the settings each process actually ended up with are returned so they can be
+recorded alongside the results.
+"""
+
+import ctypes
+import ctypes.util
+import os
+import socket
+import udpsocket
+
+MCL_CURRENT = 1
+MCL_FUTURE = 2
+
+class TuningOptions:
+
+    def __init__(self, cpus=None, fifo_priority=None, lock_memory=False,
+                 busy_poll_us=None, spin_recv=False):
+        """
+        cpus:          dictionary mapping role ('sender', 'receiver' or
+                       'server') to the CPU to pin that role's process to
+        fifo_priority: if not None, request SCHED_FIFO with this priority
+        lock_memory:   lock all current and future memory with mlockall
+        busy_poll_us:  if not None, set SO_BUSY_POLL on receive sockets
+        spin_recv:     receive by spinning on a non-blocking socket rather
+                       than sleeping in the kernel until a packet arrives
+        """
+        self.cpus = cpus or {}
+        self.fifo_priority = fifo_priority
+        self.lock_memory = lock_memory
+        self.busy_poll_us = busy_poll_us
+        self.spin_recv = spin_recv
+
+    def apply_to_process(self, role):
+        """
+        Apply the process-level options for the given role to the current
+        process. Returns the settings actually in effect afterwards, as a
+        dictionary with keys prefixed by role.
+        """
+        cpu = self.cpus.get(role)
+        if cpu is not None:
+            try:
+                os.sched_setaffinity(0, [cpu])
+            except (OSError, AttributeError) as e:
+                print("Warning: couldn't pin %s to CPU %d: %s" % (role, cpu, e))
+
+        if self.fifo_priority is not None:
+            try:
+                os.sched_setscheduler(0, os.SCHED_FIFO,
+                                      os.sched_param(self.fifo_priority))
+            except (OSError, AttributeError) as e:
+                print("Warning: couldn't set SCHED_FIFO priority %d for %s: %s" %
+                      (self.fifo_priority, role, e))
+
+        memory_locked = False
+        if self.lock_memory:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            if libc.mlockall(MCL_CURRENT | MCL_FUTURE) == 0:
+                memory_locked = True
+            else:
+                print("Warning: couldn't lock memory for %s: %s" %
+                      (role, os.strerror(ctypes.get_errno())))
+
+        settings = {'memory_locked': int(memory_locked),
+                    'spin_recv': int(self.spin_recv)}
+        try:
+            settings['cpus'] = ','.join(
+                str(c) for c in sorted(os.sched_getaffinity(0)))
+        except AttributeError:
+            pass
+        try:
+            if os.sched_getscheduler(0) == os.SCHED_FIFO:
+                settings['scheduler'] = 'fifo:%d' % \
+                    os.sched_getparam(0).sched_priority
+            else:
+                settings['scheduler'] = 'other'
+        except AttributeError:
+            pass
+
+        print("%s tuning: %s" % (role.capitalize(), settings))
+        return dict(('%s_%s' % (role, key), value)
+                    for (key, value) in settings.items())
+
+    def apply_to_socket(self, sock):
+        """
+        Apply the socket-level options to a receiving socket. Returns the
+        settings actually in effect afterwards, as a dictionary.
+        """
+        settings = {}
+        if self.busy_poll_us is not None:
+            try:
+                sock.setsockopt(socket.SOL_SOCKET, udpsocket.SO_BUSY_POLL,
+                                self.busy_poll_us)
+            except OSError as e:
+                print("Warning: couldn't set SO_BUSY_POLL: %s" % e)
+            try:
+                settings['busy_poll_us'] = \
+                    sock.getsockopt(socket.SOL_SOCKET, udpsocket.SO_BUSY_POLL)
+            except OSError:
+                pass
+        return settings
@@ -0,0 +1,135 @@
+"""
+Helpers for configuring UDP sockets and for telling packets dropped by our own
+host (because a socket's receive buffer overflowed) apart from packets lost on
+the network.
+"""
+
+import os
+import socket
+import struct
+import time
+
+# Linux socket options which the socket module doesn't export on all Python
+# versions, falling back to their values from the Linux headers
+SO_RXQ_OVFL = getattr(socket, 'SO_RXQ_OVFL', 40)
+SO_BUSY_POLL = getattr(socket, 'SO_BUSY_POLL', 46)
+
+PROC_NET_UDP_FILENAMES = ['/proc/net/udp', '/proc/net/udp6']
+
+def configure_buffers(sock, rcvbuf_bytes=None, sndbuf_bytes=None):
+    """
+    Request socket receive/send buffer sizes (leaving the system default for
+    either if None), and return the sizes actually granted by the kernel as a
+    (rcvbuf_bytes, sndbuf_bytes) tuple.
+
+    (Linux doubles the requested size to allow for book-keeping overhead, and
+    caps it at net.core.rmem_max/wmem_max.)
+    """
+    if rcvbuf_bytes is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf_bytes)
+    if sndbuf_bytes is not None:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf_bytes)
+    return (sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+            sock.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF))
+
+def read_proc_net_udp_drops(sock):
+    """
+    Look up the number of packets the kernel has dropped for this socket in
+    /proc/net/udp (or /proc/net/udp6). Returns None if the socket can't be
+    found (e.g. on a non-Linux host).
+    """
+    inode = os.fstat(sock.fileno()).st_ino
+    for filename in PROC_NET_UDP_FILENAMES:
+        try:
+            with open(filename, 'r') as proc_file:
+                lines = proc_file.read().split('\n')
+        except IOError:
+            continue
+        # Columns: sl local_address rem_address st tx_queue:rx_queue tr:tm->when
+        #          retrnsmt uid timeout inode ref pointer drops
+        for line in lines[1:]:
+            fields = line.split()
+            if len(fields) < 13:
+                continue
+            if int(fields[9]) == inode:
+                return int(fields[12])
+    return None
+
+class DropCountingSocket:
+    """
+    Wrap a receiving UDP socket so that the kernel's count of packets dropped
+    because the socket's receive buffer was full is tracked on every receive.
+
+    The count is delivered (via SO_RXQ_OVFL) as ancillary data attached to
+    received packets, and is cumulative since the socket was opened. If
+    SO_RXQ_OVFL isn't supported, receives fall back to plain recv/recvfrom and
+    n_overflow_drops stays None.
+
+    With spin=True, receives busy-wait on the (non-blocking) socket instead of
+    sleeping until a packet arrives, trading a CPU core for not having to wait
+    for the process to be woken up.
+    """
+
+    def __init__(self, sock, spin=False):
+        self.sock = sock
+        self.spin = spin
+        self.timeout_seconds = sock.gettimeout()
+        if spin:
+            sock.setblocking(False)
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RXQ_OVFL, 1)
+            self.n_overflow_drops = 0
+            self.ancillary_buffer_size = socket.CMSG_SPACE(struct.calcsize('I'))
+        except (OSError, AttributeError):
+            self.n_overflow_drops = None
+
+    def __getattr__(self, name):
+        # Everything else (settimeout, close, ...) goes to the socket itself
+        return getattr(self.sock, name)
+
+    def settimeout(self, timeout_seconds):
+        if self.spin:
+            self.timeout_seconds = timeout_seconds
+        else:
+            self.sock.settimeout(timeout_seconds)
+
+    def recv(self, buffer_size):
+        return self.recvfrom(buffer_size)[0]
+
+    def recvfrom(self, buffer_size):
+        if not self.spin:
+            return self.recvfrom_once(buffer_size)
+        if self.timeout_seconds is not None:
+            deadline_seconds = time.time() + self.timeout_seconds
+        while True:
+            try:
+                return self.recvfrom_once(buffer_size)
+            except BlockingIOError:
+                if (self.timeout_seconds is not None and
+                        time.time() > deadline_seconds):
+                    raise socket.timeout("timed out")
+
+    def recvfrom_once(self, buffer_size):
+        if self.n_overflow_drops is None:
+            return self.sock.recvfrom(buffer_size)
+        (data, ancillary_data, _, address) = \
+            self.sock.recvmsg(buffer_size, self.ancillary_buffer_size)
+        # The kernel only attaches the counter when it's non-zero
+        for (level, message_type, message_data) in ancillary_data:
+            if level == socket.SOL_SOCKET and message_type == SO_RXQ_OVFL:
+                self.n_overflow_drops = struct.unpack('I', message_data[:4])[0]
+        return (data, address)
+
+    def drop_statistics(self):
+        """
+        Return a dictionary of the drop counters we know about for this socket,
+        suitable for passing to Measurement.save_packet_latencies as metadata.
+        """
+        (rcvbuf_bytes, _) = configure_buffers(self.sock)
+        stats = {'rcvbuf_bytes': rcvbuf_bytes}
+        if self.n_overflow_drops is not None:
+            stats['rxq_overflow_drops'] = self.n_overflow_drops
+        proc_net_udp_drops = read_proc_net_udp_drops(self.sock)
+        if proc_net_udp_drops is not None:
+            stats['proc_net_udp_drops'] = proc_net_udp_drops
+        return stats